@@ -1,13 +1,23 @@
 import argparse
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+from contextlib import closing
 from pathlib import Path
+import os
+import re
 import sys
 import logging
+import time
 import z3
 
 from p4z3.contrib.tabulate import tabulate
-from get_semantics import get_z3_formulization
+from get_semantics import get_z3_formulization, get_flat_members
+from get_semantics import get_package_pipes
 import util
-from p4z3.state import P4ComplexType
+from verdict_cache import VerdictCache, CACHE_NAME
+from verdict_cache import get_query_key, get_file_key, get_bin_key
+from p4z3.base import UNDEF_LABEL
 
 sys.setrecursionlimit(15000)
 
@@ -15,6 +25,54 @@ FILE_DIR = Path(__file__).parent.resolve()
 EQUALITY_BIN = FILE_DIR.joinpath("../modules/p4c/build/p4compare")
 log = logging.getLogger(__name__)
 
+# the tactics of the default equivalence solver
+SOLVER_TACTICS = [
+    "simplify",
+    # "distribute-forall",
+    # "ackermannize_bv",
+    # "bvarray2uf",
+    # "card2bv",
+    # "propagate-bv-bounds-new",
+    # "reduce-bv-size",
+    # "qe_rec",
+    "smt",
+]
+Z3_RESULTS = {"sat": z3.sat, "unsat": z3.unsat, "unknown": z3.unknown}
+# Per-query solver budgets, a query that ends up unknown escalates to the
+# next step of the ladder. The timeout is in milliseconds, the rlimit is
+# z3's deterministic resource limit, and max_memory is in megabytes.
+# A step may also switch to a different (cheaper) tactic pipeline.
+# The last step is only tried if everything else has failed.
+# Select this ladder with "--budgets default" or pass a JSON file instead.
+DEFAULT_BUDGETS = [
+    {"timeout": 10000, "rlimit": 0, "max_memory": 4096},
+    {"timeout": 60000, "rlimit": 0, "max_memory": 8192},
+    {"timeout": 60000, "rlimit": 0, "max_memory": 8192,
+     "tactics": ["simplify", "propagate-values", "elim-uncnstr", "solve-eqs",
+                 "smt"]},
+]
+# this is z3's value for "no timeout" and "no memory limit"
+NO_TIMEOUT = 4294967295
+NO_MEMORY_LIMIT = 4294967295
+# only these outcomes of an equality check are worth caching, anything else
+# (crashes, timeouts, unknown verdicts) may turn out differently next time
+DEFINITIVE_EXIT_CODES = (util.EXIT_SUCCESS, util.EXIT_VIOLATION,
+                         util.EXIT_UNDEF)
+
+# the solver strategies we race against each other in portfolio mode
+# every entry is a name, the tactic pipeline, and the random seed of the
+# final tactic
+PORTFOLIO_STRATEGIES = [
+    ("default", ["simplify", "smt"], 0),
+    ("default_seed_1", ["simplify", "smt"], 1),
+    ("default_seed_2", ["simplify", "smt"], 2),
+    ("propagate", ["simplify", "propagate-values", "elim-uncnstr",
+                   "solve-eqs", "smt"], 0),
+    ("ackermannize", ["simplify", "ackermannize_bv", "smt"], 0),
+    ("reduce_bv", ["simplify", "propagate-bv-bounds", "reduce-bv-size",
+                   "smt"], 0),
+]
+
 # We maintain a list of passes to skip for convenience
 # This reduces the amount of noise when generating random programs
 SKIPPED_PASSES = []
@@ -47,6 +105,11 @@ def print_validation_error(prog_before, prog_after, model):
     error_string += "\n\nPROGRAM AFTER\n"
     error_string += get_hdr_table(z3_prog_after, p4_state_after.members)
     error_string += "\n\nPROPOSED INPUT BEGIN\n"
+    if isinstance(model, str):
+        # this model was loaded from the verdict cache
+        error_string += model
+        error_string += "\n--\n"
+        model = z3.Model()
     for decl in model.decls():
         value = model[decl]
         if isinstance(value, z3.DatatypeRef):
@@ -65,113 +128,568 @@ def handle_pyz3_error(fail_dir, p4_file):
     util.copy_file(failed, fail_dir)
 
 
-def substitute_taint(z3_expr):
-    decl = z3_expr.decl()
-    taint = set()
-    if decl.kind() == z3.Z3_OP_ITE:
-        # we need to differentiate in the case of ite statements
-        cond_expr = z3_expr.children()[0]
-        then_expr = z3_expr.children()[1]
-        else_expr = z3_expr.children()[2]
-        cond_expr, cond_taint = substitute_taint(cond_expr)
-        # check if the cond expr is an ite statement after substitution
+def get_taint_const(z3_expr):
+    taint_const = z3.FreshConst(z3_expr.sort(), "taint")
+    return taint_const, set([taint_const])
+
+
+def resolve_taint(z3_expr, results, progress):
+    # evaluates a single node, returns a child that still needs to be
+    # evaluated or None once the result of the node is known
+    expr_id = z3_expr.get_id()
+    if z3.is_const(z3_expr):
+        if z3_expr.decl().name() == UNDEF_LABEL:
+            # the expression is tainted replace it
+            results[expr_id] = get_taint_const(z3_expr)
+        else:
+            results[expr_id] = (z3_expr, set())
+        return None
+    state = progress.get(expr_id)
+    if state is None:
+        state = {"children": z3_expr.children(), "new": [], "taints": []}
+        progress[expr_id] = state
+    is_ite = z3.is_app_of(z3_expr, z3.Z3_OP_ITE)
+    children = state["children"]
+    while len(state["new"]) < len(children):
+        child = children[len(state["new"])]
+        if child.get_id() not in results:
+            return child
+        child, child_taint = results[child.get_id()]
+        # we only check the condition of ite statements here
         # if the condition is tainted, do not even bother to evaluate the rest
-        if cond_expr.decl().kind() != z3.Z3_OP_ITE and cond_taint:
-            taint_const = z3.FreshConst(z3_expr.sort(), "taint")
-            return taint_const, set([taint_const])
-        # evaluate the branches
-        then_expr, then_taint = substitute_taint(then_expr)
-        else_expr, else_taint = substitute_taint(else_expr)
+        check_child = not is_ite or not state["new"]
+        if check_child and child_taint and \
+                not z3.is_app_of(child, z3.Z3_OP_ITE):
+            # replace entire expression if one non-ite member is tainted
+            results[expr_id] = get_taint_const(z3_expr)
+            del progress[expr_id]
+            return None
+        state["new"].append(child)
+        state["taints"].append(child_taint)
+    del progress[expr_id]
+    child_list = state["new"]
+    taint = set()
+    for child_taint in state["taints"]:
+        taint |= child_taint
+    if is_ite:
+        _, then_expr, else_expr = child_list
+        _, then_taint, else_taint = state["taints"]
         # check if the branches are an ite statement after substitution
-        then_not_ite = then_expr.decl().kind() != z3.Z3_OP_ITE
-        else_not_ite = else_expr.decl().kind() != z3.Z3_OP_ITE
+        then_not_ite = not z3.is_app_of(then_expr, z3.Z3_OP_ITE)
+        else_not_ite = not z3.is_app_of(else_expr, z3.Z3_OP_ITE)
         if (then_not_ite and else_not_ite) and (then_taint and else_taint):
             # both branches are fully tainted, replace and return
-            taint_const = z3.FreshConst(z3_expr.sort(), "taint")
-            return taint_const, set([taint_const])
-
-        # merge taints and create a new ite statement
-        taint |= cond_taint | then_taint | else_taint
-        if taint:
-            z3_expr = z3.If(cond_expr, then_expr, else_expr)
-    elif z3.is_const(z3_expr) and str(z3_expr) == "undefined":
-        # the expression is tainted replace it
-        # really dumb check, do not need anything else
-        z3_expr = z3.FreshConst(z3_expr.sort(), "taint")
-        taint.add(z3_expr)
-    else:
-        # remaining expressions are more complex, need to evaluate children
-        child_list = z3_expr.children()
-        for idx, child in enumerate(child_list):
-            # iterate through members of the expr
-            child, child_taint = substitute_taint(child)
-            # replace entire expression if one non-ite member is tainted
-            if child.decl().kind() != z3.Z3_OP_ITE and child_taint:
-                # the expression is tainted replace it
-                taint_const = z3.FreshConst(z3_expr.sort(), "taint")
-                return taint_const, set([taint_const])
-            # members might also have changed, so update
-            taint |= child_taint
-            child_list[idx] = child
+            results[expr_id] = get_taint_const(z3_expr)
+            return None
         if taint:
-            # these are unfortunately necessary because AND/OR are "special"
-            if decl.kind() == z3.Z3_OP_AND:
-                z3_expr = z3.And(*child_list)
-            elif decl.kind() == z3.Z3_OP_OR:
-                z3_expr = z3.Or(*child_list)
-            else:
-                z3_expr = decl(*child_list)
-    return z3_expr, taint
-
-
-def undef_check(solver, prog_before, prog_after):
-    prog_before_children = prog_before.children()
-    prog_after_children = prog_after.children()
-    for idx, m_before in enumerate(prog_before_children):
+            z3_expr = z3.If(*child_list)
+    elif taint:
+        # members might also have changed, so update
+        # substitute also takes care of "special" expressions like AND/OR
+        changed = []
+        for idx, child in enumerate(children):
+            if not child.eq(child_list[idx]):
+                changed.append((child, child_list[idx]))
+        z3_expr = z3.substitute(z3_expr, *changed)
+    results[expr_id] = (z3_expr, taint)
+    return None
+
+
+def substitute_taint(z3_expr):
+    # Replace undefined values with fresh taint variables and collapse every
+    # expression that depends on a tainted value. The formula is a DAG with
+    # a lot of shared sub expressions, so we traverse it iteratively and
+    # memoize the result of every node by its AST id.
+    results = {}
+    progress = {}
+    stack = [z3_expr]
+    while stack:
+        expr = stack[-1]
+        if expr.get_id() in results:
+            stack.pop()
+            continue
+        child = resolve_taint(expr, results, progress)
+        if child is None:
+            stack.pop()
+        else:
+            stack.append(child)
+    return results[z3_expr.get_id()]
+
+
+def get_undef_query(m_before, m_after):
+    m_before, taint_vars = substitute_taint(m_before)
+    m_before = z3.simplify(m_before)
+    m_after = z3.simplify(m_after)
+    tv_equiv = m_before != m_after
+    for taint_var in taint_vars:
+        if m_before.sort() == taint_var.sort():
+            tv_equiv = z3.And(tv_equiv, m_before != taint_var)
+    tv_equiv = z3.simplify(tv_equiv)
+    return m_before, m_after, tv_equiv
+
+
+def get_undef_members(prog_before, prog_after):
+    if is_pipe_datatype(prog_before, prog_after):
+        return get_pipe_members(prog_before), get_pipe_members(prog_after)
+    return prog_before.children(), prog_after.children()
+
+
+def log_undef_violation(m_before, m_after):
+    log.error("Validation holds despite undefined behavior!")
+    log.error("MEMBER BEFORE\n%s", m_before)
+    log.error("MEMBER AFTER\n%s", m_after)
+
+
+def run_query(func, query, conn):
+    try:
+        conn.send(func(query))
+    finally:
+        conn.close()
+
+
+def race_queries(func, queries, num_procs, on_crash):
+    ''' Yields func(query) for every query as soon as it is available. Every
+    query runs in its own process, at most num_procs at a time. Once the
+    caller stops iterating (close the generator to be sure), all queries that
+    are still running are killed. A query whose process died yields
+    on_crash(query) instead. Daemonic processes, such as Pool workers, may
+    not have children, so they run the queries one after another. '''
+    if multiprocessing.current_process().daemon or num_procs < 2:
+        for query in queries:
+            yield func(query)
+        return
+    pending = list(reversed(queries))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < num_procs:
+                query = pending.pop()
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(target=run_query,
+                                               args=(func, query, send_conn),
+                                               daemon=True)
+                proc.start()
+                # only the child may hold the sending end, otherwise we never
+                # notice that it died
+                send_conn.close()
+                running[recv_conn] = (proc, query)
+            for conn in wait(list(running)):
+                proc, query = running.pop(conn)
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    proc.join()
+                    log.error("Query process %s died with exit code %s.",
+                              proc.pid, proc.exitcode)
+                    result = on_crash(query)
+                conn.close()
+                proc.join()
+                yield result
+    finally:
+        for conn, (proc, _) in running.items():
+            proc.kill()
+            proc.join()
+            conn.close()
+
+
+def check_undef_member(member_query):
+    # this runs in a worker process, so we parse the members in a fresh
+    # context and also perform the substitution of tainted values here
+    member_idx, smt_members = member_query
+    ctx = z3.Context()
+    members = z3.parse_smt2_string(smt_members, ctx=ctx)[0]
+    m_before = members.arg(0).arg(1)
+    m_after = members.arg(1).arg(1)
+    _, _, tv_equiv = get_undef_query(m_before, m_after)
+    solver = build_solver(ctx)
+    solver.add(tv_equiv)
+    return member_idx, str(solver.check())
+
+
+def undef_check_parallel(solver, members_before, members_after):
+    member_queries = []
+    for idx, m_before in enumerate(members_before):
+        m_after = members_after[idx]
+        # bind both members to markers so we can find them after parsing
+        before_marker = z3.Const("member_before", m_before.sort())
+        after_marker = z3.Const("member_after", m_after.sort())
+        smt_members = get_smt_query(
+            z3.And(before_marker == m_before, after_marker == m_after))
+        member_queries.append((idx, smt_members))
+    ret = z3.unsat
+    sat_idx = None
+    num_procs = min(len(member_queries), os.cpu_count())
+    log.info("Checking %s members with %s processes...",
+             len(member_queries), num_procs)
+    results = race_queries(check_undef_member, member_queries, num_procs,
+                           lambda query: (query[0], "unknown"))
+    with closing(results):
+        for member_idx, member_ret in results:
+            if member_ret == "sat":
+                # closing the results kills all the remaining checks
+                sat_idx = member_idx
+                break
+            if member_ret == "unknown":
+                ret = z3.unknown
+    if sat_idx is None:
+        if ret == z3.unknown:
+            log.error("Solution unknown! There might be a problem...")
+        return ret, None
+    # recheck the violating member locally to get a model
+    m_before, m_after, tv_equiv = get_undef_query(members_before[sat_idx],
+                                                  members_after[sat_idx])
+    solver.push()
+    solver.add(tv_equiv)
+    ret = solver.check()
+    model = solver.model() if ret == z3.sat else None
+    solver.pop()
+    if ret == z3.sat:
+        log_undef_violation(m_before, m_after)
+    return ret, model
+
+
+def undef_check_combined(solver, members_before, members_after):
+    # a single query, every member is guarded by its own assumption literal
+    # any model tells us which members are violating
+    member_lits = []
+    undef_members = []
+    solver.push()
+    for idx, m_before in enumerate(members_before):
         log.info("Preprocessing member %s...", idx)
-        m_after = prog_after_children[idx]
-
-        m_before, taint_vars = substitute_taint(m_before)
-        m_before = z3.simplify(m_before)
-        m_after = z3.simplify(m_after)
-        tv_equiv = m_before != m_after
-        for taint_var in taint_vars:
-            if m_before.sort() == taint_var.sort():
-                tv_equiv = z3.And(tv_equiv, m_before != taint_var)
-        tv_equiv = z3.simplify(tv_equiv)
+        m_before, m_after, tv_equiv = get_undef_query(m_before,
+                                                      members_after[idx])
+        member_lit = z3.FreshBool(f"member_{idx}")
+        solver.add(z3.Implies(member_lit, tv_equiv))
+        member_lits.append(member_lit)
+        undef_members.append((m_before, m_after))
+    solver.add(z3.Or(*member_lits))
+    ret = solver.check()
+    model = None
+    if ret == z3.sat:
+        model = solver.model()
+        for idx, member_lit in enumerate(member_lits):
+            if z3.is_true(model.eval(member_lit)):
+                log.error("Member %s violates undefined behavior.", idx)
+                log_undef_violation(*undef_members[idx])
+    elif ret == z3.unknown:
+        log.error("Solution unknown! There might be a problem...")
+    solver.pop()
+    return ret, model
+
+
+def undef_check(solver, prog_before, prog_after, undef_mode=None):
+    members_before, members_after = get_undef_members(prog_before,
+                                                      prog_after)
+    if undef_mode == "parallel":
+        return undef_check_parallel(solver, members_before, members_after)
+    if undef_mode == "combined":
+        return undef_check_combined(solver, members_before, members_after)
+    ret = z3.unsat
+    for idx, m_before in enumerate(members_before):
+        log.info("Preprocessing member %s...", idx)
+        m_after = members_after[idx]
+        m_before, m_after, tv_equiv = get_undef_query(m_before, m_after)
         # check equivalence of the modified clause
         log.debug("Checking member %s...", idx)
         log.debug("Updated equation:")
         log.debug(tv_equiv)
-        ret = solver.check(tv_equiv)
+        solver.push()
+        solver.add(tv_equiv)
+        ret = solver.check()
+        model = solver.model() if ret == z3.sat else None
+        solver.pop()
 
         if ret == z3.sat:
-            log.error("Validation holds despite undefined behavior!")
-            log.error("MEMBER BEFORE\n%s", m_before)
-            log.error("MEMBER AFTER\n%s", m_after)
-            return ret
+            log_undef_violation(m_before, m_after)
+            return ret, model
         elif ret == z3.unknown:
             log.error("Solution unknown! There might be a problem...")
-            return ret
-    return ret
+            return ret, None
+    return ret, None
 
 
 def get_hdr_table(z3_datatype, p4_z3_objs):
     z3_datatype = z3.simplify(z3_datatype)
-    flat_members = []
-    for name, p4z3_obj in p4_z3_objs:
-        if isinstance(p4z3_obj, P4ComplexType):
-            for sub_member in p4z3_obj.flat_names:
-                flat_members.append(f"{name}.{sub_member.name}")
-        else:
-            flat_members.append(name)
+    flat_members = get_flat_members(p4_z3_objs)
     outputs = z3_datatype.children()
     zipped_list = zip(flat_members, outputs)
     table = tabulate(zipped_list, headers=["NAME", "OUTPUT"])
     return table
 
 
-def check_equivalence(prog_before, prog_after, allow_undef):
+def build_solver(ctx=None, tactics=SOLVER_TACTICS):
+    z3_tactics = [z3.Tactic(tactic, ctx) for tactic in tactics]
+    t = z3.Then(*z3_tactics, ctx=ctx)
+    return t.solver()
+
+
+def add_timing(stats, query, ret, elapsed, **details):
+    # every query that reaches a solver leaves a timing record
+    if stats is None:
+        return
+    timing = {"query": query, "result": str(ret), "elapsed": elapsed}
+    timing.update(details)
+    stats.setdefault("timings", []).append(timing)
+
+
+def solve_with_budgets(solver, tv_equiv, budgets, stats=None):
+    # without any budgets we solve once without limits
+    if not budgets:
+        budgets = [{}]
+    ret = z3.unknown
+    model = None
+    for step, budget in enumerate(budgets):
+        step_solver = solver
+        if "tactics" in budget:
+            # switch to a different tactic pipeline for this step
+            step_solver = build_solver(tv_equiv.ctx, budget["tactics"])
+        step_solver.set("timeout", budget.get("timeout", NO_TIMEOUT))
+        step_solver.set("rlimit", budget.get("rlimit", 0))
+        # unlike the global memory_max_size, this only affects this solver
+        step_solver.set("max_memory",
+                        budget.get("max_memory", NO_MEMORY_LIMIT))
+        start_time = time.time()
+        # scope the query so that a shared solver can be reused
+        step_solver.push()
+        step_solver.add(tv_equiv)
+        ret = step_solver.check()
+        model = step_solver.model() if ret == z3.sat else None
+        reason = step_solver.reason_unknown() if ret == z3.unknown else ""
+        step_solver.pop()
+        elapsed = time.time() - start_time
+        log.debug("Query step %s returned %s after %.3f seconds.", step, ret,
+                  elapsed)
+        add_timing(stats, "budget", ret, elapsed, step=step, budget=budget,
+                   reason=reason)
+        if ret != z3.unknown:
+            break
+        if step + 1 < len(budgets):
+            log.warning("Query returned unknown (%s), escalating to step %s.",
+                        reason, step + 1)
+    # reset the limits so that follow-up checks are not affected
+    solver.set("timeout", NO_TIMEOUT)
+    solver.set("rlimit", 0)
+    solver.set("max_memory", NO_MEMORY_LIMIT)
+    return ret, model
+
+
+def load_budgets(budgets_arg):
+    # the argparse type of --budgets
+    if budgets_arg == "default":
+        return DEFAULT_BUDGETS
+    try:
+        with open(budgets_arg, "r") as json_file:
+            budgets = json.load(json_file)
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(
+            f"Could not load budgets from {budgets_arg}: {e}")
+    if not isinstance(budgets, list):
+        raise argparse.ArgumentTypeError(
+            f"Budgets in {budgets_arg} must be a list of steps.")
+    return budgets
+
+
+def get_smt_query(z3_expr):
+    # serialize the expression including all its declarations
+    solver = z3.Solver()
+    solver.add(z3_expr)
+    return solver.to_smt2()
+
+
+def parse_smt_query(smt_query, ctx):
+    # the inverse of get_smt_query, the printer drops trivially true queries
+    assertions = list(z3.parse_smt2_string(smt_query, ctx=ctx))
+    if len(assertions) == 1:
+        return assertions[0]
+    return z3.And(assertions + [z3.BoolVal(True, ctx)])
+
+
+def get_canonical_query(z3_expr):
+    # the let-bound names of the smt2 printer are internal AST ids, which
+    # differ between processes, so number them in order of appearance
+    names = {}
+
+    def rename(match):
+        return names.setdefault(match.group(0), f"?v{len(names)}")
+
+    return re.sub(r"[?$]x\d+", rename, get_smt_query(z3_expr))
+
+
+def simplify_pipes(pipes):
+    # simplify the formula of every pipe exactly once
+    # the result can be reused for multiple comparisons
+    simplified_pipes = {}
+    for pipe_name, (z3_prog, p4_state, pipe_cls) in pipes.items():
+        simplified_pipes[pipe_name] = (z3.simplify(z3_prog), p4_state,
+                                       pipe_cls)
+    return simplified_pipes
+
+
+def extract_pipe_member(z3_expr, idx, cache):
+    # push the member access through any if-then-else branches
+    # the formula is a DAG, so memoize on the id of the sub expression
+    expr_id = z3_expr.get_id()
+    if expr_id in cache:
+        return cache[expr_id]
+    pipe_sort = z3_expr.sort()
+    if z3.is_app_of(z3_expr, z3.Z3_OP_ITE):
+        cond_expr, then_expr, else_expr = z3_expr.children()
+        then_member = extract_pipe_member(then_expr, idx, cache)
+        else_member = extract_pipe_member(else_expr, idx, cache)
+        member = z3.If(cond_expr, then_member, else_member)
+    elif z3_expr.decl().eq(pipe_sort.constructor(0)):
+        member = z3_expr.arg(idx)
+    else:
+        member = pipe_sort.accessor(0, idx)(z3_expr)
+    cache[expr_id] = member
+    return member
+
+
+def get_pipe_members(z3_prog):
+    constructor = z3_prog.sort().constructor(0)
+    if z3_prog.decl().eq(constructor):
+        # the members are directly accessible
+        return z3_prog.children()
+    # the pipe is wrapped in if-then-else branches, extract every member
+    members = []
+    for idx in range(constructor.arity()):
+        member = extract_pipe_member(z3_prog, idx, {})
+        members.append(z3.simplify(member))
+    return members
+
+
+def is_pipe_datatype(z3_prog_before, z3_prog_after):
+    pipe_sort = z3_prog_before.sort()
+    if not pipe_sort.eq(z3_prog_after.sort()):
+        return False
+    if not isinstance(pipe_sort, z3.DatatypeSortRef):
+        return False
+    return pipe_sort.num_constructors() == 1
+
+
+def is_structurally_equal(z3_prog_before, z3_prog_after):
+    # z3 hash-conses its terms, identical formulas share the same id
+    if z3_prog_before.eq(z3_prog_after):
+        return True
+    if not is_pipe_datatype(z3_prog_before, z3_prog_after):
+        return False
+    # the formulas differ, but the individual members might still be identical
+    members_before = get_pipe_members(z3_prog_before)
+    members_after = get_pipe_members(z3_prog_after)
+    for m_before, m_after in zip(members_before, members_after):
+        if not m_before.eq(m_after):
+            return False
+    return True
+
+
+def check_member_query(member_query):
+    # this runs in a worker process, so we parse the query in a fresh context
+    # the timing records go back to the parent with the verdict
+    member_idx, smt_query, budgets = member_query
+    ctx = z3.Context()
+    tv_equiv = parse_smt_query(smt_query, ctx)
+    stats = {}
+    ret, _ = solve_with_budgets(build_solver(ctx), tv_equiv, budgets, stats)
+    return member_idx, str(ret), stats.get("timings", [])
+
+
+def add_query_timings(stats, timings, **details):
+    # timing records of worker processes, tagged with what the worker did
+    if stats is None:
+        return
+    for timing in timings:
+        timing.update(details)
+        stats.setdefault("timings", []).append(timing)
+
+
+def check_fieldwise(z3_prog_before, z3_prog_after, flat_members,
+                    budgets=None, stats=None):
+    # check every member of the pipe as its own, much smaller, query
+    members_before = get_pipe_members(z3_prog_before)
+    members_after = get_pipe_members(z3_prog_after)
+    member_queries = []
+    member_equivs = {}
+    for member_idx, m_before in enumerate(members_before):
+        member_equiv = z3.simplify(m_before != members_after[member_idx])
+        if z3.is_false(member_equiv):
+            # trivially equivalent, nothing to check
+            continue
+        member_queries.append((member_idx, get_smt_query(member_equiv),
+                               budgets))
+        member_equivs[member_idx] = member_equiv
+    ret = z3.unsat
+    if not member_queries:
+        return ret, None
+    num_procs = min(len(member_queries), os.cpu_count())
+    log.debug("Checking %s members with %s processes...",
+              len(member_queries), num_procs)
+    results = race_queries(check_member_query, member_queries, num_procs,
+                           lambda query: (query[0], "unknown", []))
+    with closing(results):
+        for member_idx, member_ret, timings in results:
+            add_query_timings(stats, timings, member=member_idx)
+            if member_ret == "sat":
+                if member_idx < len(flat_members):
+                    member_name = flat_members[member_idx]
+                else:
+                    member_name = member_idx
+                log.error("Member %s is not equivalent!", member_name)
+                # closing the results kills all the remaining queries
+                return z3.sat, member_equivs[member_idx]
+            if member_ret == "unknown":
+                ret = z3.unknown
+    return ret, None
+
+
+def solve_strategy(strategy_query):
+    # this runs in a worker process, so we parse the query in a fresh context
+    strategy_name, tactics, seed, smt_query, budgets = strategy_query
+    ctx = z3.Context()
+    stats = {}
+    try:
+        z3_tactics = [z3.Tactic(tactic, ctx) for tactic in tactics]
+        z3_tactics[-1] = z3.With(z3_tactics[-1], random_seed=seed)
+        solver = z3.Then(*z3_tactics, ctx=ctx).solver()
+        tv_equiv = parse_smt_query(smt_query, ctx)
+        ret, model = solve_with_budgets(solver, tv_equiv, budgets, stats)
+    except z3.Z3Exception as e:
+        # some tactics do not support all theories, this is not fatal
+        log.debug("Strategy %s failed: %s", strategy_name, e)
+        return strategy_name, "unknown", "", stats.get("timings", [])
+    model = model.sexpr() if ret == z3.sat else ""
+    return strategy_name, str(ret), model, stats.get("timings", [])
+
+
+def check_portfolio(tv_equiv, budgets=None, stats=None):
+    # race all strategies on the same query, the first definitive answer wins
+    smt_query = get_smt_query(tv_equiv)
+    strategy_queries = []
+    for strategy_name, tactics, seed in PORTFOLIO_STRATEGIES:
+        strategy_queries.append((strategy_name, tactics, seed, smt_query,
+                                 budgets))
+    results = race_queries(solve_strategy, strategy_queries,
+                           len(strategy_queries),
+                           lambda query: (query[0], "unknown", "", []))
+    with closing(results):
+        for strategy_name, verdict, model, timings in results:
+            add_query_timings(stats, timings, strategy=strategy_name)
+            if verdict != "unknown":
+                log.info("Strategy %s won with verdict \"%s\".",
+                         strategy_name, verdict)
+                # closing the results kills all the remaining strategies
+                return Z3_RESULTS[verdict], model, strategy_name
+    return z3.unknown, "", None
+
+
+def count_stat(stats, key):
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + 1
+
+
+def check_equivalence(prog_before, prog_after, allow_undef, solver=None,
+                      is_simplified=False, stats=None, fieldwise=False,
+                      cache=None, portfolio=False, budgets=None,
+                      undef_mode=None):
     # The equivalence check of the solver
     # For all input packets and possible table matches the programs should
     # be the same
@@ -180,8 +698,15 @@ def check_equivalence(prog_before, prog_after, allow_undef):
     undef_violation = False
 
     try:
-        z3_prog_before = z3.simplify(z3_prog_before)
-        z3_prog_after = z3.simplify(z3_prog_after)
+        if not is_simplified:
+            z3_prog_before = z3.simplify(z3_prog_before)
+            z3_prog_after = z3.simplify(z3_prog_after)
+        if is_structurally_equal(z3_prog_before, z3_prog_after):
+            # no need to build the equation or invoke the solver, the
+            # formulas are identical
+            log.debug("Formulas are structurally identical.")
+            count_stat(stats, "structural")
+            return util.EXIT_SUCCESS
         # the equivalence equation
         log.debug("Simplifying equation...")
         tv_equiv = z3.simplify(z3_prog_before != z3_prog_after)
@@ -195,23 +720,57 @@ def check_equivalence(prog_before, prog_after, allow_undef):
         error_string += get_hdr_table(z3_prog_after, input_names_after)
         log.error(error_string)
         return util.EXIT_VIOLATION
+    cache_key = None
+    if cache is not None:
+        # the verdict depends on the query and the way we solve it
+        solver_config = ",".join(SOLVER_TACTICS)
+        if portfolio:
+            solver_config = "portfolio"
+        cache_key = get_query_key(get_canonical_query(tv_equiv),
+                                  solver_config,
+                                  f"budgets={json.dumps(budgets)}",
+                                  f"allow_undef={allow_undef}")
+        cached = cache.get(cache_key)
+        # older caches may still hold unknown verdicts, ignore them
+        if cached is not None and cached[0] in ("sat", "unsat"):
+            verdict, exit_code, model = cached
+            log.info("Using cached verdict \"%s\".", verdict)
+            count_stat(stats, "cached")
+            if verdict == "sat":
+                print_validation_error(prog_before, prog_after, model)
+            return exit_code
+    count_stat(stats, "solver")
     log.debug("Checking...")
     log.debug(z3.tactics())
-    t = z3.Then(
-        z3.Tactic("simplify"),
-        # z3.Tactic("distribute-forall"),
-        # z3.Tactic("ackermannize_bv"),
-        # z3.Tactic("bvarray2uf"),
-        # z3.Tactic("card2bv"),
-        # z3.Tactic("propagate-bv-bounds-new"),
-        # z3.Tactic("reduce-bv-size"),
-        # z3.Tactic("qe_rec"),
-        z3.Tactic("smt"),
-    )
-
-    solver = t.solver()
+    if solver is None:
+        solver = build_solver()
     log.debug(solver.sexpr())
-    ret = solver.check(tv_equiv)
+    ret = z3.sat
+    model = None
+    if fieldwise and is_pipe_datatype(z3_prog_before, z3_prog_after):
+        p4_state = prog_before[1]
+        flat_members = get_flat_members(p4_state.members) if p4_state else []
+        start_time = time.time()
+        ret, member_equiv = check_fieldwise(z3_prog_before, z3_prog_after,
+                                            flat_members, budgets, stats)
+        add_timing(stats, "fieldwise", ret, time.time() - start_time)
+        if member_equiv is not None:
+            # only the diverging member needs to be solved again for a model
+            tv_equiv = member_equiv
+        elif ret == z3.unknown:
+            # the members are no final answer, try the whole query instead
+            log.warning("Fieldwise check was inconclusive, "
+                        "falling back to the full query.")
+            ret = z3.sat
+    if ret == z3.sat and portfolio:
+        start_time = time.time()
+        ret, model, winner = check_portfolio(tv_equiv, budgets, stats)
+        add_timing(stats, "portfolio", ret, time.time() - start_time,
+                   winner=winner)
+        if stats is not None and winner:
+            stats.setdefault("winners", []).append(winner)
+    elif ret == z3.sat:
+        ret, model = solve_with_budgets(solver, tv_equiv, budgets, stats)
     log.debug(tv_equiv)
     log.debug(ret)
     if allow_undef and ret == z3.sat:
@@ -219,46 +778,180 @@ def check_equivalence(prog_before, prog_after, allow_undef):
         # if we allow undefined changes we need to explicitly recheck
         log.info("Detected difference in undefined behavior. "
                  "Rechecking while substituting undefined variables.")
-        ret = undef_check(solver, z3_prog_before, z3_prog_after)
+        start_time = time.time()
+        ret, model = undef_check(solver, z3_prog_before, z3_prog_after,
+                                 undef_mode)
+        add_timing(stats, "undef", ret, time.time() - start_time,
+                   mode=undef_mode or "sequential")
 
+    model_str = ""
     if ret == z3.sat:
-        print_validation_error(prog_before, prog_after, solver.model())
-        return util.EXIT_VIOLATION
+        print_validation_error(prog_before, prog_after, model)
+        exit_code = util.EXIT_VIOLATION
+        model_str = model if isinstance(model, str) else model.sexpr()
     elif ret == z3.unknown:
         log.error("Solution unknown! There might be a problem...")
-        return util.EXIT_VIOLATION
+        exit_code = util.EXIT_VIOLATION
+    elif undef_violation:
+        exit_code = util.EXIT_UNDEF
     else:
-        if undef_violation:
-            return util.EXIT_UNDEF
-        return util.EXIT_SUCCESS
+        exit_code = util.EXIT_SUCCESS
+    if cache_key is not None and ret != z3.unknown:
+        # an unknown verdict depends on the limits and the machine load
+        cache.put(cache_key, str(ret), exit_code, model_str)
+    return exit_code
 
 
-def z3_check(prog_paths, fail_dir=None, allow_undef=False):
-    # useful information to track
-    info = {}
+def find_divergence(base_idx, last_idx, check_pair):
+    # binary search for the first program that is no longer equivalent to the
+    # program at base_idx, returns None if base and last are equivalent
+    if check_pair(base_idx, last_idx) == util.EXIT_SUCCESS:
+        return None
+    lo_idx = base_idx
+    hi_idx = last_idx
+    while hi_idx - lo_idx > 1:
+        mid_idx = (lo_idx + hi_idx) // 2
+        if check_pair(base_idx, mid_idx) == util.EXIT_SUCCESS:
+            lo_idx = mid_idx
+        else:
+            hi_idx = mid_idx
+    return hi_idx
 
-    if len(prog_paths) < 2:
-        log.error("Equivalence checks require at least two input programs!")
-        return util.EXIT_FAILURE, info
+
+def bisect_chain(num_progs, check_pair, check_adjacent):
+    # Equivalence is transitive, so if the first program is equivalent to the
+    # last program all the passes in between must be correct as well.
+    # Only if this check fails we bisect the list to find the faulty pass.
+    # check_pair is used for the search, check_adjacent reports the culprit.
     has_undef = False
+    base_idx = 0
+    last_idx = num_progs - 1
+    while base_idx < last_idx:
+        div_idx = find_divergence(base_idx, last_idx, check_pair)
+        if div_idx is None:
+            break
+        log.info("Bisection points at pass %s, checking it directly...",
+                 div_idx)
+        ret = check_adjacent(div_idx - 1, div_idx)
+        if ret == util.EXIT_UNDEF:
+            # undefined behavior is not fatal, continue after this pass
+            has_undef = True
+        elif ret != util.EXIT_SUCCESS:
+            return ret
+        base_idx = div_idx
+    if has_undef:
+        return util.EXIT_UNDEF
+    return util.EXIT_SUCCESS
+
+
+def run_equality_check(prog_paths, silent=False, cache=None):
+    cache_key = None
+    if cache is not None:
+        # the same pass dumps recur across reruns, key on their content
+        cache_key = get_query_key(get_file_key(*prog_paths),
+                                  get_bin_key(EQUALITY_BIN))
+        cached = cache.get(cache_key)
+        # older caches may still hold crashes and timeouts, ignore them
+        if cached is not None and cached[1] in DEFINITIVE_EXIT_CODES:
+            _, exit_code, _ = cached
+            log.info("Using cached equality result %s.", exit_code)
+            return exit_code
     prog_path_strs = [str(prog_path) for prog_path in prog_paths]
     prog_str = ",".join(prog_path_strs)
     cmd = f"{EQUALITY_BIN} "
     cmd += f"{prog_str} "
     lvl = log.getEffectiveLevel()
-    log.setLevel(logging.DEBUG)
-    ret = util.exec_process(cmd)
+    if not silent:
+        log.setLevel(logging.DEBUG)
+    ret = util.exec_process(cmd, silent=silent)
     log.setLevel(lvl)
-    if ret.returncode != util.EXIT_SUCCESS:
-        return ret.returncode, info
-    if has_undef:
+    if cache_key is not None and ret.returncode in DEFINITIVE_EXIT_CODES:
+        cache.put(cache_key, None, ret.returncode)
+    return ret.returncode
+
+
+def z3_check(prog_paths, fail_dir=None, allow_undef=False, bisect=False,
+             cache=None, check_opts=None, pass_names=None):
+    # check_opts are the options of the in-process checker, see
+    # get_check_opts, without them we run p4compare
+    if check_opts:
+        return z3_check_old(prog_paths, fail_dir, allow_undef, bisect=bisect,
+                            cache=cache, pass_names=pass_names,
+                            **check_opts)
+    # pass_names name the pass behind each position of the chain, a pruned
+    # chain may refer to the same file for different passes
+    if pass_names is None:
+        pass_names = [str(prog_path) for prog_path in prog_paths]
+    # useful information to track
+    info = {}
+
+    if len(prog_paths) < 2:
+        log.error("Equivalence checks require at least two input programs!")
+        return util.EXIT_FAILURE, info
+    if bisect:
+        def check_pair(pre_idx, post_idx):
+            pair = [prog_paths[pre_idx], prog_paths[post_idx]]
+            return run_equality_check(pair, True, cache)
+
+        def check_adjacent(pre_idx, post_idx):
+            info["prog_before"] = str(prog_paths[pre_idx])
+            info["prog_after"] = str(prog_paths[post_idx])
+            info["pass_before"] = pass_names[pre_idx]
+            info["pass_after"] = pass_names[post_idx]
+            return run_equality_check(prog_paths[pre_idx:post_idx + 1],
+                                      cache=cache)
+
+        ret = bisect_chain(len(prog_paths), check_pair, check_adjacent)
+    else:
+        ret = run_equality_check(prog_paths, cache=cache)
+    if ret == util.EXIT_UNDEF:
         log.info("Passed all checks but encountered unstable code.")
         return util.EXIT_UNDEF, info
+    if ret != util.EXIT_SUCCESS:
+        return ret, info
     log.info("Passed all checks!")
     return util.EXIT_SUCCESS, info
 
 
-def z3_check_old(prog_paths, fail_dir=None, allow_undef=False):
+def compare_pipes(pipes_pre, pipes_post, allow_undef, solvers=None,
+                  stats=None, fieldwise=False, cache=None, portfolio=False,
+                  budgets=None, undef_mode=None):
+    if len(pipes_pre) != len(pipes_post):
+        log.warning("Pre and post model differ in size!")
+        return util.EXIT_SKIPPED
+    has_undef = False
+    for pipe_name in pipes_pre:
+        pipe_pre = pipes_pre[pipe_name]
+        pipe_post = pipes_post[pipe_name]
+        log.info("Checking z3 equivalence for pipe %s...", pipe_name)
+        if solvers is not None:
+            if pipe_name not in solvers:
+                solvers[pipe_name] = build_solver()
+            ret = check_equivalence(pipe_pre, pipe_post, allow_undef,
+                                    solvers[pipe_name], True, stats,
+                                    fieldwise, cache, portfolio, budgets,
+                                    undef_mode)
+        else:
+            ret = check_equivalence(pipe_pre, pipe_post, allow_undef,
+                                    stats=stats, fieldwise=fieldwise,
+                                    cache=cache, portfolio=portfolio,
+                                    budgets=budgets, undef_mode=undef_mode)
+        if ret == util.EXIT_UNDEF:
+            has_undef = True
+        elif ret != util.EXIT_SUCCESS:
+            return ret
+    if has_undef:
+        return util.EXIT_UNDEF
+    return util.EXIT_SUCCESS
+
+
+def z3_check_old(prog_paths, fail_dir=None, allow_undef=False,
+                 incremental=False, bisect=False, fieldwise=False,
+                 cache=None, portfolio=False, budgets=None,
+                 undef_mode=None, translation_cache=False,
+                 pass_names=None):
+    if pass_names is None:
+        pass_names = [str(prog_path) for prog_path in prog_paths]
     # useful information to track
     info = {}
 
@@ -266,55 +959,200 @@ def z3_check_old(prog_paths, fail_dir=None, allow_undef=False):
         log.error("Equivalence checks require at least two input programs!")
         return util.EXIT_FAILURE, info
     z3_progs = []
-    for p4_prog in prog_paths:
+    for idx, p4_prog in enumerate(prog_paths):
         p4_path = Path(p4_prog)
-        package, result = get_z3_formulization(p4_path)
+        package, result = get_z3_formulization(
+            p4_path, use_cache=translation_cache)
+        if result == util.EXIT_SUCCESS:
+            pipes, result = get_package_pipes(package)
         if result != util.EXIT_SUCCESS:
             if fail_dir and result != util.EXIT_SKIPPED:
                 info["prog_before"] = str(p4_path)
                 info["prog_after"] = str(p4_path)
+                info["pass_before"] = pass_names[idx]
+                info["pass_after"] = pass_names[idx]
                 handle_pyz3_error(fail_dir, p4_path)
                 debug_msg([p4_path, p4_path])
             return result, info
-        pipes = package.get_pipes()
+        if incremental:
+            # every pass is compared twice, so only simplify it once
+            pipes = simplify_pipes(pipes)
         z3_progs.append((p4_path, pipes))
-    has_undef = False
-    for idx in range(1, len(z3_progs)):
-        p4_pre_path, pipes_pre = z3_progs[idx - 1]
-        p4_post_path, pipes_post = z3_progs[idx]
+    # in incremental mode we keep one solver per pipe for the whole chain
+    solvers = {} if incremental else None
+    # track how many pairs could be decided without invoking the solver
+    info["checks"] = []
+    info["structural_checks"] = 0
+    info["cached_checks"] = 0
+    info["solver_checks"] = 0
+    # which portfolio strategy answered first, used to tune the defaults
+    info["portfolio_wins"] = {}
+    # the timing record of every solver query
+    info["query_timings"] = []
+
+    def check_pair(pre_idx, post_idx):
+        p4_pre_path, pipes_pre = z3_progs[pre_idx]
+        p4_post_path, pipes_post = z3_progs[post_idx]
         log.info("\nComparing programs\n%s\n%s\n########", p4_pre_path.stem,
                  p4_post_path.stem)
+        stats = {"structural": 0, "cached": 0, "solver": 0, "winners": [],
+                 "timings": []}
+        ret = compare_pipes(pipes_pre, pipes_post, allow_undef, solvers,
+                            stats, fieldwise, cache, portfolio, budgets,
+                            undef_mode)
+        info["structural_checks"] += stats["structural"]
+        info["cached_checks"] += stats["cached"]
+        info["solver_checks"] += stats["solver"]
+        for winner in stats["winners"]:
+            wins = info["portfolio_wins"].get(winner, 0)
+            info["portfolio_wins"][winner] = wins + 1
+        check_info = {
+            "prog_before": str(p4_pre_path),
+            "prog_after": str(p4_post_path),
+            "pass_before": pass_names[pre_idx],
+            "pass_after": pass_names[post_idx],
+            "result": ret,
+        }
+        if stats["solver"]:
+            check_info["method"] = "solver"
+        elif stats["cached"]:
+            check_info["method"] = "cached"
+        elif ret == util.EXIT_SUCCESS:
+            check_info["method"] = "structural"
+        else:
+            check_info["method"] = "solver"
+        for timing in stats["timings"]:
+            timing["prog_before"] = str(p4_pre_path)
+            timing["prog_after"] = str(p4_post_path)
+            info["query_timings"].append(timing)
+        info["checks"].append(check_info)
+        return ret
+
+    def check_adjacent(pre_idx, post_idx):
+        p4_pre_path, _ = z3_progs[pre_idx]
+        p4_post_path, _ = z3_progs[post_idx]
         # sometimes we want to skip a specific pass
-        if needs_skipping(str(p4_post_path)):
-            continue
-        if len(pipes_pre) != len(pipes_post):
-            log.warning("Pre and post model differ in size!")
-            return util.EXIT_SKIPPED, info
-        for pipe_name in pipes_pre:
-            pipe_pre = pipes_pre[pipe_name]
-            pipe_post = pipes_post[pipe_name]
-            log.info("Checking z3 equivalence for pipe %s...", pipe_name)
-            ret = check_equivalence(pipe_pre, pipe_post, allow_undef)
-            if ret != util.EXIT_SUCCESS:
-                info["prog_before"] = str(p4_pre_path)
-                info["prog_after"] = str(p4_post_path)
-                if fail_dir:
-                    handle_pyz3_error(fail_dir, p4_pre_path)
-                    handle_pyz3_error(fail_dir, p4_post_path)
-                    debug_msg([p4_pre_path, p4_post_path])
-                if ret == util.EXIT_UNDEF:
-                    has_undef = True
-                    continue
-                return ret, info
-    if has_undef:
+        if needs_skipping(pass_names[post_idx]):
+            return util.EXIT_SUCCESS
+        ret = check_pair(pre_idx, post_idx)
+        if ret not in (util.EXIT_SUCCESS, util.EXIT_SKIPPED):
+            info["prog_before"] = str(p4_pre_path)
+            info["prog_after"] = str(p4_post_path)
+            info["pass_before"] = pass_names[pre_idx]
+            info["pass_after"] = pass_names[post_idx]
+            if fail_dir:
+                handle_pyz3_error(fail_dir, p4_pre_path)
+                handle_pyz3_error(fail_dir, p4_post_path)
+                debug_msg([p4_pre_path, p4_post_path])
+        return ret
+
+    # skipped passes break transitivity, so bisection is not possible
+    if bisect and not any(needs_skipping(pass_name)
+                          for pass_name in pass_names[1:]):
+        ret = bisect_chain(len(z3_progs), check_pair, check_adjacent)
+    else:
+        has_undef = False
+        ret = util.EXIT_SUCCESS
+        for idx in range(1, len(z3_progs)):
+            ret = check_adjacent(idx - 1, idx)
+            if ret == util.EXIT_UNDEF:
+                has_undef = True
+            elif ret != util.EXIT_SUCCESS:
+                break
+        if ret == util.EXIT_SUCCESS and has_undef:
+            ret = util.EXIT_UNDEF
+    log.info("Decided %s of %s pipe comparisons structurally.",
+             info["structural_checks"],
+             info["structural_checks"] + info["cached_checks"] +
+             info["solver_checks"])
+    if ret == util.EXIT_UNDEF:
         log.info("Passed all checks but encountered unstable code.")
         return util.EXIT_UNDEF, info
+    if ret != util.EXIT_SUCCESS:
+        return ret, info
     log.info("Passed all checks!")
     return util.EXIT_SUCCESS, info
 
 
+def add_check_args(parser):
+    ''' Adds the options of the in-process checker to a command line parser,
+    get_check_opts reads them back. '''
+    group = parser.add_argument_group(
+        "in-process checker",
+        "Any of these options checks the programs with z3 in this process "
+        "instead of p4compare.")
+    group.add_argument("--incremental",
+                       dest="incremental",
+                       action="store_true",
+                       help="Keep one solver per pipe for the whole chain "
+                       "and simplify every program only once.")
+    group.add_argument("--fieldwise",
+                       dest="fieldwise",
+                       action="store_true",
+                       help="Check every member of a pipe as its own query.")
+    group.add_argument("--portfolio",
+                       dest="portfolio",
+                       action="store_true",
+                       help="Race several solver strategies on every query.")
+    group.add_argument("--budgets",
+                       dest="budgets",
+                       default=None,
+                       type=load_budgets,
+                       help="A JSON file with a list of solver budgets to "
+                       "escalate through, or \"default\" for the built-in "
+                       "ladder.")
+    group.add_argument("--undef_mode",
+                       dest="undef_mode",
+                       default=None,
+                       choices=["parallel", "combined"],
+                       help="How to recheck undefined behavior, by default "
+                       "every member is checked one after another.")
+    group.add_argument("--translation_cache",
+                       dest="translation_cache",
+                       action="store_true",
+                       help="Reuse cached translations of the P4 to Python "
+                       "translator and their compiled bytecode instead of "
+                       "always running both.")
+
+
+def get_check_opts(args):
+    # returns None if no option of the in-process checker is set
+    check_opts = {
+        "incremental": args.incremental,
+        "fieldwise": args.fieldwise,
+        "portfolio": args.portfolio,
+        "budgets": args.budgets,
+        "undef_mode": args.undef_mode,
+        "translation_cache": args.translation_cache,
+    }
+    if not any(check_opts.values()):
+        return None
+    return check_opts
+
+
 def main(args):
-    result, _ = z3_check(args.progs, None, args.allow_undef)
+    check_opts = get_check_opts(args)
+    if not args.no_server:
+        # a running semantics server already has all the modules loaded
+        params = {
+            "progs": [str(Path(prog).resolve()) for prog in args.progs],
+            "allow_undef": args.allow_undef,
+            "bisect": args.bisect,
+            "check_opts": check_opts,
+        }
+        if args.cache_dir:
+            params["cache_dir"] = str(Path(args.cache_dir).resolve())
+        if args.log_file:
+            # the server appends the log of the request to our log file
+            params["log_file"] = str(Path(args.log_file).resolve())
+        response = util.call_server("check_equivalence", params)
+        if response is not None:
+            return response["result"]
+    cache = None
+    if args.cache_dir:
+        cache = VerdictCache(Path(args.cache_dir).joinpath(CACHE_NAME))
+    result, _ = z3_check(args.progs, None, args.allow_undef, args.bisect,
+                         cache, check_opts)
     return result
 
 
@@ -332,6 +1170,24 @@ if __name__ == '__main__':
                         dest="allow_undef",
                         action="store_true",
                         help="Ignore changes in undefined behavior.")
+    parser.add_argument("-b",
+                        "--bisect",
+                        dest="bisect",
+                        action="store_true",
+                        help="Compare the first and last program and only "
+                        "bisect the list if they are not equivalent.")
+    parser.add_argument("-c",
+                        "--cache_dir",
+                        dest="cache_dir",
+                        default=None,
+                        help="Store equivalence verdicts in this folder "
+                        "and reuse them across runs.")
+    parser.add_argument("--no_server",
+                        dest="no_server",
+                        action="store_true",
+                        help="Do not send the check to a running semantics "
+                        "server, always run it locally.")
+    add_check_args(parser)
     parser.add_argument("-l",
                         "--log_file",
                         dest="log_file",
@@ -2,17 +2,20 @@ import random
 import string
 import logging
 import argparse
-from multiprocessing import Pool
-from functools import wraps
+from functools import partial, wraps
 from pathlib import Path
 import errno
 import os
 import signal
-import time
 import json
 
 import util
+import check_p4_pair as z3check
 import validate_p4_translation as validation
+import generate_p4_test as p4_test
+from task_scheduler import TASK_ERROR, TASK_TIMEOUT, TASK_CRASHED
+from fuzz_pipeline import Pipeline, Stage, ProcessStage, Finished, QUEUE_SIZE
+from fuzz_metrics import FuzzMetrics, METRICS_INTERVAL
 
 # configure logging
 log = logging.getLogger(__name__)
@@ -33,8 +36,28 @@ CRASH_BUG_DIR = OUTPUT_DIR.joinpath("crash_bugs")
 VALIDATION_BUG_DIR = OUTPUT_DIR.joinpath("validation_bugs")
 UNDEF_DIR = OUTPUT_DIR.joinpath("unstable_code")
 TIMEOUT_DIR = OUTPUT_DIR.joinpath("timeout_bugs")
+# the outcomes of a test that do not leave a bug behind
+PASSED_OUTCOME = "passed"
+KNOWN_BUG_OUTCOME = "known_bugs"
+ERROR_OUTCOME = "errors"
+OUTCOMES = [
+    PASSED_OUTCOME, KNOWN_BUG_OUTCOME, GENERATOR_BUG_DIR.name,
+    CRASH_BUG_DIR.name, VALIDATION_BUG_DIR.name, UNDEF_DIR.name,
+    TIMEOUT_DIR.name, ERROR_OUTCOME
+]
 ITERATIONS = 100
 NUM_PROCESSES = 4
+# the parent kills a test that takes longer than this many seconds
+# this is a last resort, the validation steps have their own timeouts
+# not to be confused with the TASK_TIMEOUT status of the task scheduler
+TEST_TIMEOUT = 1800
+# workers are replaced after this many tests to cap their memory growth
+MAX_TASKS_PER_CHILD = 20
+# the default concurrency of the light stages of the fuzzing pipeline
+# the solving stage uses num_processes workers
+GENERATE_WORKERS = 1
+COMPILE_WORKERS = 2
+DUMP_WORKERS = 2
 
 KNOWN_BUGS = [
     # these are temporary bugs in p4c
@@ -177,101 +200,134 @@ def is_known_bug(result):
 
 
 @timeout(seconds=600)
-def validate_p4(p4_file, target_dir, p4c_bin, log_file):
-    p4z3_cmd = "python3 "
-    p4z3_cmd += f"{FILE_DIR.joinpath('validate_p4_translation.py')} "
-    p4z3_cmd += f"-i {p4_file} "
-    p4z3_cmd += f"-o {target_dir} "
-    p4z3_cmd += f"-p {p4c_bin} "
-    p4z3_cmd += f"-l {log_file} "
-    # distinguish between well-defined and undefined validation errors
-    p4z3_cmd += "-u "
-    # also dump info which we can reuse for various purposes
-    p4z3_cmd += "-d "
-    result = util.exec_process(p4z3_cmd, silent=True)
-    return result.returncode
+def dump_p4_passes(p4_file, target_dir, p4c_bin, log_file):
+    # the workers have the validation modules loaded already, so we call them
+    # directly instead of paying for a fresh interpreter per program
+    util.del_dir(target_dir)
+    with util.log_to_file(log_file):
+        try:
+            return validation.dump_passes(p4_file, target_dir, p4c_bin)
+        except TimeoutError:
+            raise
+        except Exception:
+            log.exception("Dumping the passes of %s crashed:\n", p4_file)
+            return None, None
 
 
 @timeout(seconds=600)
-def validate_p4_blackbox(p4_file, target_dir, log_file, config):
-    p4z3_cmd = "python3 "
-    p4z3_cmd += f"{FILE_DIR.joinpath('generate_p4_test.py')} "
-    p4z3_cmd += f"-i {p4_file} "
-    p4z3_cmd += f"-o {target_dir} "
-    p4z3_cmd += f"-l {log_file} "
-    p4z3_cmd += f"-a {config['arch']} "
-    if config["randomize_input"]:
-        p4z3_cmd += "-r "
-    result = util.exec_process(p4z3_cmd, silent=True)
-    time.sleep(3)
-    return result.returncode
+def validate_p4(p4_file, target_dir, p4c_bin, passes, log_file, bisect=False,
+                use_cache=False, check_opts=None, pass_names=None):
+    if passes is None:
+        # the passes could not be dumped, this is a failure of its own
+        return util.EXIT_FAILURE
+    # share equivalence verdicts across all workers and runs
+    # the dump folder is deleted after each test, so use the output folder
+    cache_dir = OUTPUT_DIR if use_cache else None
+    with util.log_to_file(log_file, mode="a"):
+        try:
+            # distinguish between well-defined and undefined validation
+            # errors and also dump info which we can reuse for pruning
+            return validation.check_passes(p4_file, target_dir, p4c_bin,
+                                           passes, True, True, bisect,
+                                           cache_dir, check_opts,
+                                           pass_names)
+        except TimeoutError:
+            raise
+        except Exception:
+            log.exception("Validation of %s crashed:\n", p4_file)
+            return util.EXIT_FAILURE
 
 
-def validate(dump_dir, p4_file, log_file, config):
+@timeout(seconds=600)
+def validate_p4_blackbox(p4_file, target_dir, log_file, config):
+    test_config = p4_test.get_test_config(config["arch"])
+    if config["randomize_input"]:
+        p4_test.randomize_z3_input()
+    out_dir = target_dir.joinpath(p4_file.stem)
+    util.del_dir(out_dir)
+    test_config["out_dir"] = out_dir
+    test_config["p4_input"] = p4_file
+    with util.log_to_file(log_file):
+        try:
+            return p4_test.perform_blackbox_test(test_config)
+        except TimeoutError:
+            raise
+        except Exception:
+            log.exception("Blackbox test of %s crashed:\n", p4_file)
+            return util.EXIT_FAILURE
+
+
+def dump_timeout(p4_file, log_file):
+    log.error("Validation timed out.")
+    dump_file(TIMEOUT_DIR, p4_file)
+    dump_file(TIMEOUT_DIR, log_file)
+
+
+def validate(test, config):
+    p4_file = test["p4_file"]
+    log_file = test["log_file"]
+    target_dir = test["dump_dir"].joinpath(p4_file.stem)
     try:
-        result = validate_p4(p4_file, dump_dir, config["compiler_bin"],
-                             log_file)
+        result = validate_p4(p4_file, target_dir, config["compiler_bin"],
+                             test["passes"], log_file, config["bisect"],
+                             config["use_cache"], config["check_opts"],
+                             test["pass_names"])
     except TimeoutError:
-        log.error("Validation timed out.")
-        dump_file(TIMEOUT_DIR, p4_file)
-        dump_file(TIMEOUT_DIR, log_file)
-        # reset the dump directory
-        return util.EXIT_FAILURE
-    if result != util.EXIT_SUCCESS:
-        info_file = p4_file.with_suffix("").joinpath(
-            f"{p4_file.stem}_info.json")
-        bug_dir = None
-        if result == util.EXIT_UNDEF:
-            log.error("Found instance of unstable code!")
-            bug_dir = UNDEF_DIR
-        else:
-            log.error("Failed to validate the P4 code!")
-            bug_dir = VALIDATION_BUG_DIR
-        log.error("Rerun the example with:")
-        out_file = bug_dir.joinpath(p4_file.name)
-        log.error("python3 bin/validate_p4_translation -u -i %s", out_file)
-        dump_file(bug_dir, log_file)
-        dump_file(bug_dir, p4_file)
-        dump_file(bug_dir, info_file)
-        if config["do_prune"]:
-            info_file = bug_dir.joinpath(f"{p4_file.stem}_info.json")
-            p4_cmd = f"{PRUNER_BIN} "
-            p4_cmd += f"--config {info_file} "
-            p4_cmd += f" {bug_dir.joinpath(f'{p4_file.stem}.p4')} "
-            p4_cmd += f" --working-dir {bug_dir.joinpath(f'{p4_file.stem}')}"
-            log.info("Pruning P4 file with command %s ", p4_cmd)
-            util.start_process(p4_cmd)
-    return result
+        dump_timeout(p4_file, log_file)
+        return TIMEOUT_DIR.name
+    if result == util.EXIT_SUCCESS:
+        return PASSED_OUTCOME
+    info_file = p4_file.with_suffix("").joinpath(f"{p4_file.stem}_info.json")
+    bug_dir = None
+    if result == util.EXIT_UNDEF:
+        log.error("Found instance of unstable code!")
+        bug_dir = UNDEF_DIR
+    else:
+        log.error("Failed to validate the P4 code!")
+        bug_dir = VALIDATION_BUG_DIR
+    log.error("Rerun the example with:")
+    out_file = bug_dir.joinpath(p4_file.name)
+    log.error("python3 bin/validate_p4_translation -u -i %s", out_file)
+    dump_file(bug_dir, log_file)
+    dump_file(bug_dir, p4_file)
+    dump_file(bug_dir, info_file)
+    if config["do_prune"]:
+        info_file = bug_dir.joinpath(f"{p4_file.stem}_info.json")
+        p4_cmd = f"{PRUNER_BIN} "
+        p4_cmd += f"--config {info_file} "
+        p4_cmd += f" {bug_dir.joinpath(f'{p4_file.stem}.p4')} "
+        p4_cmd += f" --working-dir {bug_dir.joinpath(f'{p4_file.stem}')}"
+        log.info("Pruning P4 file with command %s ", p4_cmd)
+        util.start_process(p4_cmd)
+    return bug_dir.name
 
 
 def run_p4_test(dump_dir, p4_file, log_file, config):
     try:
         result = validate_p4_blackbox(p4_file, dump_dir, log_file, config)
     except TimeoutError:
-        log.error("Validation timed out.")
-        dump_file(TIMEOUT_DIR, p4_file)
-        dump_file(TIMEOUT_DIR, log_file)
-        # reset the dump directory
-        return util.EXIT_FAILURE
-    if result != util.EXIT_SUCCESS:
-        log.error("Generated test case failed!")
-        log.error("Rerun the example with:")
-        out_file = VALIDATION_BUG_DIR.joinpath(p4_file.name)
-        if config["arch"] == "tna":
-            err_log = dump_dir.joinpath(Path(p4_file.stem + "_ptf_err.log"))
-            dump_file(VALIDATION_BUG_DIR, err_log)
-        log.error("python3 bin/generate_test_case -i %s", out_file)
-        # FIXME: This is a bit awkward
-        # since it depends on the name generated by the test script
-        stf_name = dump_dir.joinpath(Path(p4_file.stem))
-        stf_name = stf_name.joinpath(Path(p4_file.stem + ".stf"))
-        dump_file(VALIDATION_BUG_DIR, stf_name)
-        dump_file(VALIDATION_BUG_DIR, log_file)
-        dump_file(VALIDATION_BUG_DIR, p4_file)
-    return result
-
-
-def check(idx, config):
+        dump_timeout(p4_file, log_file)
+        return TIMEOUT_DIR.name
+    if result == util.EXIT_SUCCESS:
+        return PASSED_OUTCOME
+    log.error("Generated test case failed!")
+    log.error("Rerun the example with:")
+    out_file = VALIDATION_BUG_DIR.joinpath(p4_file.name)
+    if config["arch"] == "tna":
+        err_log = dump_dir.joinpath(Path(p4_file.stem + "_ptf_err.log"))
+        dump_file(VALIDATION_BUG_DIR, err_log)
+    log.error("python3 bin/generate_test_case -i %s", out_file)
+    # FIXME: This is a bit awkward
+    # since it depends on the name generated by the test script
+    stf_name = dump_dir.joinpath(Path(p4_file.stem))
+    stf_name = stf_name.joinpath(Path(p4_file.stem + ".stf"))
+    dump_file(VALIDATION_BUG_DIR, stf_name)
+    dump_file(VALIDATION_BUG_DIR, log_file)
+    dump_file(VALIDATION_BUG_DIR, p4_file)
+    return VALIDATION_BUG_DIR.name
+
+
+def generate_test(idx, config):
     test_id = generate_id()
     test_name = f"{test_id}_{idx}"
     dump_dir = OUTPUT_DIR.joinpath(f"dmp_{test_name}")
@@ -287,46 +343,137 @@ def check(idx, config):
         dump_result(result, GENERATOR_BUG_DIR, p4_file)
         # reset the dump directory
         util.del_dir(dump_dir)
-        return result.returncode
-    # check compilation
+        return Finished(GENERATOR_BUG_DIR.name)
+    return {"idx": idx, "dump_dir": dump_dir, "log_file": log_file,
+            "p4_file": p4_file, "passes": None, "pass_names": None}
+
+
+def compile_test(test, config):
+    dump_dir = test["dump_dir"]
+    p4_file = test["p4_file"]
     result = compile_p4_prog(config["compiler_bin"], p4_file, dump_dir)
-    if result.returncode != util.EXIT_SUCCESS:
-        if not is_known_bug(result):
-            log.error("Failed to compile the P4 code!")
-            log.error("Found a new bug!")
-            dump_result(result, CRASH_BUG_DIR, p4_file)
-            dump_file(CRASH_BUG_DIR, p4_file)
-            if config["do_prune"]:
-                info_file = CRASH_BUG_DIR.joinpath(f"{p4_file.stem}_info.json")
-                info = validation.INFO
-                # customize the main info with the new information
-                info["compiler"] = str(config["compiler_bin"])
-                info["exit_code"] = result.returncode
-                info["p4z3_bin"] = str(P4Z3_BIN)
-                info["out_dir"] = str(CRASH_BUG_DIR)
-                info["input_file"] = str(p4_file)
-                info["allow_undef"] = False
-                info["err_string"] = result.stderr.decode("utf-8")
-                log.error("Dumping configuration to %s.", info_file)
-                with open(info_file, 'w') as json_file:
-                    json.dump(info, json_file, indent=2, sort_keys=True)
-                p4_cmd = f"{PRUNER_BIN} "
-                p4_cmd += f"--config {info_file} "
-                p4_cmd += f" {CRASH_BUG_DIR.joinpath(f'{p4_file.stem}.p4')} "
-                log.error("Pruning P4 file with command %s ", p4_cmd)
-                util.start_process(p4_cmd)
-        # reset the dump directory
-        util.del_dir(dump_dir)
-        return result
+    if result.returncode == util.EXIT_SUCCESS:
+        return test
+    outcome = KNOWN_BUG_OUTCOME
+    if not is_known_bug(result):
+        outcome = CRASH_BUG_DIR.name
+        log.error("Failed to compile the P4 code!")
+        log.error("Found a new bug!")
+        dump_result(result, CRASH_BUG_DIR, p4_file)
+        dump_file(CRASH_BUG_DIR, p4_file)
+        if config["do_prune"]:
+            info_file = CRASH_BUG_DIR.joinpath(f"{p4_file.stem}_info.json")
+            info = dict(validation.INFO)
+            # customize the main info with the new information
+            info["compiler"] = str(config["compiler_bin"])
+            info["exit_code"] = result.returncode
+            info["p4z3_bin"] = str(P4Z3_BIN)
+            info["out_dir"] = str(CRASH_BUG_DIR)
+            info["input_file"] = str(p4_file)
+            info["allow_undef"] = False
+            info["err_string"] = result.stderr.decode("utf-8")
+            log.error("Dumping configuration to %s.", info_file)
+            with open(info_file, 'w') as json_file:
+                json.dump(info, json_file, indent=2, sort_keys=True)
+            p4_cmd = f"{PRUNER_BIN} "
+            p4_cmd += f"--config {info_file} "
+            p4_cmd += f" {CRASH_BUG_DIR.joinpath(f'{p4_file.stem}.p4')} "
+            log.error("Pruning P4 file with command %s ", p4_cmd)
+            util.start_process(p4_cmd)
+    # reset the dump directory
+    util.del_dir(dump_dir)
+    return Finished(outcome)
+
+
+def dump_test(test, config):
+    # only translation validation needs the compiler passes
+    p4_file = test["p4_file"]
+    log_file = test["log_file"]
+    target_dir = test["dump_dir"].joinpath(p4_file.stem)
+    try:
+        test["passes"], test["pass_names"] = dump_p4_passes(
+            p4_file, target_dir, config["compiler_bin"], log_file)
+    except TimeoutError:
+        dump_timeout(p4_file, log_file)
+        util.del_dir(test["dump_dir"])
+        return Finished(TIMEOUT_DIR.name)
+    return test
+
+
+def solve_test(test, config):
+    outcome = PASSED_OUTCOME
     # check validation
     if config["do_validate"]:
-        result = validate(dump_dir, p4_file, log_file, config)
+        outcome = validate(test, config)
     elif config["use_blackbox"]:
-        result = run_p4_test(dump_dir, p4_file, log_file, config)
-
+        outcome = run_p4_test(test["dump_dir"], test["p4_file"],
+                              test["log_file"], config)
     # reset the dump directory
-    util.del_dir(dump_dir)
-    return result
+    util.del_dir(test["dump_dir"])
+    return Finished(outcome)
+
+
+def check(idx, config):
+    # runs all the stages of a single test one after another
+    stages = [compile_test]
+    if config["do_validate"]:
+        stages.append(dump_test)
+    stages.append(solve_test)
+    test = generate_test(idx, config)
+    for stage in stages:
+        if isinstance(test, Finished):
+            break
+        test = stage(test, config)
+    return test
+
+
+def salvage_test(idx):
+    # the worker running this test was killed, keep its program around
+    # the dump directory name is only known to the worker, so search for it
+    for dump_dir in OUTPUT_DIR.glob(f"dmp_*_{idx}"):
+        log.error("Test %s did not finish, moving it to %s.", dump_dir.name,
+                  TIMEOUT_DIR)
+        for test_file in dump_dir.glob(f"{dump_dir.name[4:]}.*"):
+            dump_file(TIMEOUT_DIR, test_file)
+        util.del_dir(dump_dir)
+
+
+def handle_failure(task_result):
+    # the task is either the index of a test or a test that was generated
+    test = task_result.task
+    idx = test["idx"] if isinstance(test, dict) else test
+    if task_result.status in (TASK_TIMEOUT, TASK_CRASHED):
+        salvage_test(idx)
+
+
+def record_result(metrics, stage_name, task_result):
+    metrics.add_latency(stage_name, task_result.elapsed)
+    if task_result.status in (TASK_TIMEOUT, TASK_CRASHED):
+        # the salvaged program ends up in the timeout folder
+        metrics.add_outcome(TIMEOUT_DIR.name)
+    elif task_result.status == TASK_ERROR:
+        metrics.add_outcome(ERROR_OUTCOME)
+    elif isinstance(task_result.value, Finished):
+        outcome = task_result.value.outcome
+        if outcome not in OUTCOMES:
+            # every exported label must be known up front, a stray value
+            # would silently create a new time series
+            log.error("Stage %s finished %s with unknown outcome %r.",
+                      stage_name, task_result.task, outcome)
+            outcome = ERROR_OUTCOME
+        metrics.add_outcome(outcome)
+
+
+def init_worker(process_limits, log_file, log_level):
+    # workers start from a clean interpreter, give them the setup of main
+    util.set_process_limits(**process_limits)
+    logging.basicConfig(filename=log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, log_level),
+                        filemode="a")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
 
 
 class TestLauncher():
@@ -334,7 +481,11 @@ class TestLauncher():
         self._config = config
 
     def __call__(self, idx):
-        return check(idx, self._config)
+        try:
+            return check(idx, self._config)
+        finally:
+            # collect the pruners that finished in the meantime
+            util.reap_processes()
 
 
 def validate_choice(args):
@@ -367,6 +518,9 @@ def validate_choice(args):
     config["do_prune"] = args.do_prune
     config["use_blackbox"] = args.use_blackbox
     config["randomize_input"] = args.randomize_input
+    config["bisect"] = args.bisect
+    config["use_cache"] = args.use_cache
+    config["check_opts"] = z3check.get_check_opts(args)
     config["compiler_bin"] = SUPPORT_MATRIX[config["arch"]]["compiler"]
 
     return util.EXIT_SUCCESS, config
@@ -378,18 +532,52 @@ def main(args):
         return result
 
     util.check_dir(OUTPUT_DIR)
+    # the workers apply these limits to every tool they launch
+    memory_limit = None
+    if args.memory_limit:
+        memory_limit = args.memory_limit * 1024 * 1024
+    util.set_process_limits(args.process_timeout, memory_limit,
+                            args.cpu_limit)
 
     # initialize with some pre-configured state
     launch = TestLauncher(config)
+    # a local scraper can pick up the progress of the campaign from here
+    metrics = FuzzMetrics(OUTPUT_DIR, OUTCOMES, TIMEOUT_DIR.name,
+                          interval=args.metrics_interval)
 
     if config["arch"] == "tna":
         # the tofino tests only support single threaded mode for now
         for idx in range(args.iterations):
-            launch(idx)
+            metrics.add_outcome(launch(idx).outcome)
+        metrics.dump()
         return util.EXIT_SUCCESS
-    # this sometimes deadlocks, no idea why....
-    with Pool(args.num_processes) as p:
-        p.map(launch, range(args.iterations))
+    # the light stages run in threads, the heavy ones in worker processes
+    # every stage has its own pool, so the solvers get most of the cores
+    # while the generator stays ahead of them
+    worker_args = (dict(util.PROCESS_LIMITS), args.log_file, args.log_level)
+    stages = [
+        Stage("generate", partial(generate_test, config=config),
+              args.generate_workers),
+        Stage("compile", partial(compile_test, config=config),
+              args.compile_workers),
+    ]
+    if config["do_validate"]:
+        stages.append(
+            ProcessStage("dump", partial(dump_test, config=config),
+                         args.dump_workers, args.task_timeout,
+                         args.max_tasks_per_child, init_worker, worker_args))
+    stages.append(
+        ProcessStage("solve", partial(solve_test, config=config),
+                     args.num_processes, args.task_timeout,
+                     args.max_tasks_per_child, init_worker, worker_args))
+    pipeline = Pipeline(stages, args.queue_size, handle_failure,
+                        partial(record_result, metrics))
+    pipeline.run(range(args.iterations))
+    snapshot = metrics.dump()
+    log.info("Finished %s tests in %.1f seconds (%.2f per second).",
+             snapshot["programs"], snapshot["elapsed"],
+             snapshot["programs_per_sec"])
+    log.info("Outcomes: %s", snapshot["outcomes"])
     return util.EXIT_SUCCESS
 
 
@@ -428,7 +616,64 @@ if __name__ == "__main__":
                         dest="num_processes",
                         default=NUM_PROCESSES,
                         type=int,
-                        help="How many processes to launch.")
+                        help="How many programs to solve in parallel.")
+    parser.add_argument("-t",
+                        "--task_timeout",
+                        dest="task_timeout",
+                        default=TEST_TIMEOUT,
+                        type=int,
+                        help="Kill a test after this many seconds.")
+    parser.add_argument("--max_tasks_per_child",
+                        dest="max_tasks_per_child",
+                        default=MAX_TASKS_PER_CHILD,
+                        type=int,
+                        help="Replace a worker process after this many tests.")
+    parser.add_argument("--process_timeout",
+                        dest="process_timeout",
+                        default=None,
+                        type=int,
+                        help="Kill any external tool and its children after "
+                        "this many seconds.")
+    parser.add_argument("--memory_limit",
+                        dest="memory_limit",
+                        default=None,
+                        type=int,
+                        help="The address space limit of every external tool "
+                        "in MiB.")
+    parser.add_argument("--cpu_limit",
+                        dest="cpu_limit",
+                        default=None,
+                        type=int,
+                        help="The cpu time limit of every external tool in "
+                        "seconds.")
+    parser.add_argument("--generate_workers",
+                        dest="generate_workers",
+                        default=GENERATE_WORKERS,
+                        type=int,
+                        help="How many programs to generate in parallel.")
+    parser.add_argument("--compile_workers",
+                        dest="compile_workers",
+                        default=COMPILE_WORKERS,
+                        type=int,
+                        help="How many programs to compile in parallel.")
+    parser.add_argument("--dump_workers",
+                        dest="dump_workers",
+                        default=DUMP_WORKERS,
+                        type=int,
+                        help="How many programs to dump passes for in "
+                        "parallel.")
+    parser.add_argument("--queue_size",
+                        dest="queue_size",
+                        default=QUEUE_SIZE,
+                        type=int,
+                        help="How many programs may wait between two stages "
+                        "of the pipeline.")
+    parser.add_argument("--metrics_interval",
+                        dest="metrics_interval",
+                        default=METRICS_INTERVAL,
+                        type=int,
+                        help="Export the campaign metrics at most every this "
+                        "many seconds.")
     parser.add_argument("-o",
                         "--out_dir",
                         dest="out_dir",
@@ -444,6 +689,16 @@ if __name__ == "__main__":
                         dest="do_prune",
                         action="store_true",
                         help="Turn on to try to prune errors.")
+    parser.add_argument("--bisect",
+                        dest="bisect",
+                        action="store_true",
+                        help="Bisect the compiler passes during validation "
+                        "instead of checking every pass pair.")
+    parser.add_argument("--cache",
+                        dest="use_cache",
+                        action="store_true",
+                        help="Cache equivalence verdicts in the output "
+                        "folder.")
     parser.add_argument(
         "-ll",
         "--log_level",
@@ -451,6 +706,7 @@ if __name__ == "__main__":
         default="INFO",
         choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
         help="The log level to choose.")
+    z3check.add_check_args(parser)
     # Parse options and process argv
     arguments = parser.parse_args()
     # configure logging
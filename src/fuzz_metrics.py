@@ -0,0 +1,141 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from collections import Counter, OrderedDict, deque
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+METRICS_NAME = "metrics"
+# the minimum number of seconds between two exports
+METRICS_INTERVAL = 10
+# the prefix of every exported OpenMetrics family
+METRICS_PREFIX = "p4z3_fuzz"
+PERCENTILES = (50, 90, 99)
+# percentiles are computed over this many of the most recent samples
+LATENCY_WINDOW = 1000
+
+
+def get_percentile(sorted_samples, percentile):
+    # nearest-rank percentile, good enough for monitoring
+    rank = math.ceil(percentile / 100 * len(sorted_samples))
+    return sorted_samples[max(rank, 1) - 1]
+
+
+def write_atomic(out_file, data):
+    # a scraper must never read a half-written file
+    fd, tmp_file = tempfile.mkstemp(dir=out_file.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp:
+        tmp.write(data)
+    os.replace(tmp_file, out_file)
+
+
+class FuzzMetrics():
+    ''' Tracks the throughput of a fuzzing campaign: how many programs ended
+    with which outcome and how long each stage of a test took. The metrics
+    are exported to <name>.json and to <name>.prom in the OpenMetrics text
+    format, at most once every interval seconds and on every explicit dump.
+    The timeout rate is the share of programs with the timeout_outcome. '''
+
+    def __init__(self, out_dir, outcomes=(), timeout_outcome=None,
+                 name=METRICS_NAME, interval=METRICS_INTERVAL):
+        out_dir = Path(out_dir)
+        self.json_file = out_dir.joinpath(f"{name}.json")
+        self.prom_file = out_dir.joinpath(f"{name}.prom")
+        self.interval = interval
+        self.timeout_outcome = timeout_outcome
+        self.start_time = time.monotonic()
+        self.last_dump = self.start_time
+        # list every known outcome, even if it never happens
+        self.outcomes = Counter({outcome: 0 for outcome in outcomes})
+        self.latencies = OrderedDict()
+        self.latency_counts = Counter()
+        self.latency_sums = Counter()
+
+    def add_latency(self, stage, elapsed):
+        samples = self.latencies.setdefault(stage,
+                                            deque(maxlen=LATENCY_WINDOW))
+        samples.append(elapsed)
+        self.latency_counts[stage] += 1
+        self.latency_sums[stage] += elapsed
+        self.maybe_dump()
+
+    def add_outcome(self, outcome):
+        self.outcomes[outcome] += 1
+        self.maybe_dump()
+
+    def maybe_dump(self):
+        if time.monotonic() - self.last_dump >= self.interval:
+            self.dump()
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.start_time
+        num_programs = sum(self.outcomes.values())
+        stages = OrderedDict()
+        for stage, samples in self.latencies.items():
+            sorted_samples = sorted(samples)
+            stage_info = {
+                "count": self.latency_counts[stage],
+                "sum": self.latency_sums[stage],
+                "max": sorted_samples[-1],
+            }
+            for percentile in PERCENTILES:
+                stage_info[f"p{percentile}"] = get_percentile(
+                    sorted_samples, percentile)
+            stages[stage] = stage_info
+        timeout_rate = 0.0
+        if num_programs:
+            timeout_rate = self.outcomes[self.timeout_outcome] / num_programs
+        return {
+            "elapsed": elapsed,
+            "programs": num_programs,
+            "programs_per_sec": num_programs / elapsed if elapsed else 0.0,
+            "timeout_rate": timeout_rate,
+            "outcomes": dict(self.outcomes),
+            "stages": stages,
+        }
+
+    def to_openmetrics(self, snapshot):
+        lines = []
+        name = f"{METRICS_PREFIX}_programs"
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"# HELP {name} Finished programs by outcome.")
+        for outcome, count in snapshot["outcomes"].items():
+            lines.append(f"{name}_total{{outcome=\"{outcome}\"}} {count}")
+        for key, help_str in (
+                ("programs_per_sec", "Finished programs per second."),
+                ("timeout_rate", "Share of programs that timed out.")):
+            name = f"{METRICS_PREFIX}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"# HELP {name} {help_str}")
+            lines.append(f"{name} {snapshot[key]}")
+        name = f"{METRICS_PREFIX}_stage_latency_seconds"
+        lines.append(f"# TYPE {name} summary")
+        lines.append(f"# HELP {name} Wall time of a test in each stage.")
+        for stage, stage_info in snapshot["stages"].items():
+            for percentile in PERCENTILES:
+                lines.append(f"{name}{{stage=\"{stage}\","
+                             f"quantile=\"{percentile / 100}\"}} "
+                             f"{stage_info[f'p{percentile}']}")
+            lines.append(f"{name}_count{{stage=\"{stage}\"}} "
+                         f"{stage_info['count']}")
+            lines.append(f"{name}_sum{{stage=\"{stage}\"}} "
+                         f"{stage_info['sum']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        self.last_dump = time.monotonic()
+        snapshot = self.snapshot()
+        try:
+            write_atomic(self.json_file, json.dumps(snapshot, indent=2))
+            write_atomic(self.prom_file, self.to_openmetrics(snapshot))
+        except OSError as e:
+            # metrics are for monitoring, never fail the campaign because
+            # of them
+            log.warning("Could not export metrics to %s: %s",
+                        self.json_file.parent, e)
+        return snapshot
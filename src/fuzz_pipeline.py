@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from task_scheduler import TaskScheduler, TaskResult
+from task_scheduler import TASK_DONE, TASK_ERROR
+
+log = logging.getLogger(__name__)
+
+# the default number of items that may wait between two stages
+QUEUE_SIZE = 8
+# how often a process stage looks for new items while its tasks are running
+POLL_INTERVAL = 0.1
+# marks the end of the item stream in a queue
+NO_ITEM = object()
+
+# a stage function returns this when an item needs no further stages
+Finished = namedtuple("Finished", ["outcome"])
+
+
+class Stage():
+    ''' A pipeline stage that applies func to every item of its input queue
+    in num_workers threads. This suits stages that mostly wait on external
+    tools. The return value of func is passed on to the next stage, None or
+    a Finished value take the item out of the pipeline. '''
+
+    def __init__(self, name, func, num_workers):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+
+    async def run(self, in_queue, out_queue, on_result):
+        loop = asyncio.get_running_loop()
+
+        async def run_worker(executor):
+            while True:
+                item = await in_queue.get()
+                if item is NO_ITEM:
+                    # let the other workers of this stage see the end as well
+                    await in_queue.put(NO_ITEM)
+                    return
+                start_time = time.monotonic()
+                try:
+                    value = await loop.run_in_executor(executor, self.func,
+                                                       item)
+                except Exception:
+                    status, value = TASK_ERROR, traceback.format_exc()
+                else:
+                    status = TASK_DONE
+                result = TaskResult(item, status, value,
+                                    time.monotonic() - start_time)
+                await forward(self.name, result, out_queue, on_result)
+
+        with ThreadPoolExecutor(self.num_workers,
+                                thread_name_prefix=self.name) as executor:
+            await asyncio.gather(
+                *(run_worker(executor) for _ in range(self.num_workers)))
+        await out_queue.put(NO_ITEM)
+
+
+class ProcessStage(Stage):
+    ''' A pipeline stage that runs func in a TaskScheduler. This suits
+    stages that are heavy on the CPU, a task that exceeds task_timeout is
+    killed and reported like a crashed one. Every worker process calls
+    initializer(*initargs) before its first task. '''
+
+    def __init__(self, name, func, num_workers, task_timeout=None,
+                 max_tasks_per_child=None, initializer=None, initargs=()):
+        super(ProcessStage, self).__init__(name, func, num_workers)
+        self.task_timeout = task_timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.initializer = initializer
+        self.initargs = initargs
+
+    async def run(self, in_queue, out_queue, on_result):
+        loop = asyncio.get_running_loop()
+        scheduler = TaskScheduler(self.func, self.num_workers,
+                                  self.task_timeout, self.max_tasks_per_child,
+                                  self.initializer, self.initargs)
+        scheduler.start()
+        has_items = True
+        try:
+            while has_items or scheduler.num_busy():
+                while has_items and scheduler.has_idle():
+                    if not scheduler.num_busy():
+                        item = await in_queue.get()
+                    elif not in_queue.empty():
+                        item = in_queue.get_nowait()
+                    else:
+                        # do not block while there are tasks to collect
+                        break
+                    if item is NO_ITEM:
+                        has_items = False
+                        break
+                    scheduler.submit(item)
+                results = await loop.run_in_executor(None, scheduler.collect,
+                                                     POLL_INTERVAL)
+                for result in results:
+                    await forward(self.name, result, out_queue, on_result)
+        finally:
+            scheduler.close()
+        await out_queue.put(NO_ITEM)
+
+
+async def forward(stage_name, result, out_queue, on_result):
+    if result.status == TASK_ERROR:
+        log.error("Stage %s failed on %s:\n%s", stage_name, result.task,
+                  result.value)
+    on_result(stage_name, result)
+    if result.status != TASK_DONE:
+        return
+    if result.value is not None and not isinstance(result.value, Finished):
+        await out_queue.put(result.value)
+
+
+class Pipeline():
+    ''' Runs a sequence of stages concurrently. The stages are connected by
+    bounded queues, so a fast stage blocks once queue_size items wait for
+    the next one instead of running ahead. on_failure receives the
+    TaskResult of every item that failed, timed out, or crashed, on_result
+    receives the stage name and TaskResult of every item a stage processed.
+    '''
+
+    def __init__(self, stages, queue_size=QUEUE_SIZE, on_failure=None,
+                 on_result=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_failure = on_failure
+        self.on_result = on_result
+
+    def _handle_result(self, stage_name, result):
+        if self.on_result:
+            self.on_result(stage_name, result)
+        if result.status != TASK_DONE and self.on_failure:
+            self.on_failure(result)
+
+    async def _feed(self, items, queue):
+        for item in items:
+            await queue.put(item)
+        await queue.put(NO_ITEM)
+
+    async def _drain(self, queue):
+        num_items = 0
+        while await queue.get() is not NO_ITEM:
+            num_items += 1
+        return num_items
+
+    async def run_async(self, items):
+        queues = [asyncio.Queue(self.queue_size)
+                  for _ in range(len(self.stages) + 1)]
+        jobs = [self._feed(items, queues[0])]
+        for idx, stage in enumerate(self.stages):
+            jobs.append(stage.run(queues[idx], queues[idx + 1],
+                                  self._handle_result))
+        jobs.append(self._drain(queues[-1]))
+        results = await asyncio.gather(*jobs)
+        return results[-1]
+
+    def run(self, items):
+        ''' Returns the number of items that made it through all stages. '''
+        return asyncio.run(self.run_async(items))
@@ -9,7 +9,7 @@ from pathlib import Path
 
 import z3
 import util
-from get_semantics import get_z3_formulization
+from get_semantics import get_z3_formulization, get_package_pipes
 
 log = logging.getLogger(__name__)
 FILE_DIR = Path(__file__).parent.resolve()
@@ -79,7 +79,7 @@ def convert_to_stf(input_values):
 
 def cleanup(procs):
     for proc in procs:
-        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+        util.kill_process_tree(proc, signal.SIGTERM)
 
 
 def save_error(err_path, stdout, stderr):
@@ -140,13 +140,16 @@ def get_prog_semantics(config):
             err_file.write(result.stderr.decode("utf-8"))
         util.copy_file([p4_input, py_file], fail_dir)
         return None, result.returncode
-    package, result = get_z3_formulization(py_file)
-    pipe_val = package.get_pipes()
+    # we only need the pipe we generate tests for, skip all others
+    pipe_names = [config["pipe_name"]]
+    package, result = get_z3_formulization(py_file, pipe_names=pipe_names)
+    if result == util.EXIT_SUCCESS:
+        pipe_val, result = get_package_pipes(package, pipe_names)
     if result != util.EXIT_SUCCESS:
         if fail_dir and result != util.EXIT_SKIPPED:
             util.check_dir(fail_dir)
             util.copy_file([p4_input, py_file], fail_dir)
-        return pipe_val, result
+        return None, result
     return pipe_val, util.EXIT_SUCCESS
 
 
@@ -547,23 +550,23 @@ def perform_blackbox_test(config):
     return run_stf_test(config, stf_str)
 
 
-def main(args):
+def randomize_z3_input():
+    seed = int.from_bytes(os.getrandom(8), "big")
+    z3.set_param(
+        "smt.phase_selection",
+        5,
+        "smt.random_seed",
+        seed,
+        "smt.arith.random_initial_value",
+        True,
+        "sat.phase",
+        "random",
+    )
 
-    if args.randomize_input:
-        seed = int.from_bytes(os.getrandom(8), "big")
-        z3.set_param(
-            "smt.phase_selection",
-            5,
-            "smt.random_seed",
-            seed,
-            "smt.arith.random_initial_value",
-            True,
-            "sat.phase",
-            "random",
-        )
 
+def get_test_config(arch):
     config = {}
-    config["arch"] = args.arch
+    config["arch"] = arch
     if config["arch"] == "tna":
         config["pipe_name"] = "pipe0_ingress"
         config["ingress_var"] = "ingress"
@@ -575,6 +578,15 @@ def main(args):
         config["ingress_var"] = "ig"
     else:
         raise RuntimeError("Unsupported test arch \"%s\"!" % config["arch"])
+    return config
+
+
+def main(args):
+
+    if args.randomize_input:
+        randomize_z3_input()
+
+    config = get_test_config(args.arch)
 
     if args.p4_input:
         p4_input = Path(args.p4_input)
@@ -1,45 +1,110 @@
 import argparse
 from pathlib import Path
 import sys
-import importlib
+import builtins
+import marshal
+import itertools
+import json
 import logging
 import time
 from datetime import datetime
 import z3
 
-from p4z3.contrib.tabulate import tabulate
 from p4z3.state import StaticContext, P4ComplexType, P4Extern
 
 import util
 from p4z3.externs.core import core_externs
+from translation_cache import TranslationCache, get_translation_key
+from verdict_cache import get_query_key
+from pipe_semantics import StoredState, StoredType, SEMANTICS_SUFFIX
+from pipe_semantics import StoredPackage, deserialize_pipes
+from pipe_semantics import dump_semantics, load_semantics
+from phase_timer import PhaseTimer
 
 sys.setrecursionlimit(15000)
 
 FILE_DIR = Path(__file__).parent.resolve()
 P4Z3_BIN = FILE_DIR.joinpath("../modules/p4c/build/p4toz3")
+P4_INCLUDE_DIR = FILE_DIR.joinpath("../modules/p4c/p4include")
 OUT_DIR = FILE_DIR.joinpath("../validated")
+TRANSLATION_CACHE_NAME = "translation_cache"
+BYTECODE_CACHE_NAME = "bytecode_cache"
+# print_z3_data stops after this many paths through a pipe
+MAX_PATHS = 1000
+# how many compiled programs a single process keeps in memory
+MAX_LOADED_IR = 128
+LOADED_IR = {}
+# the translation and bytecode caches of every output folder
+CACHES = {}
 log = logging.getLogger(__name__)
 
 
-def import_prog(ctrl_dir, ctrl_name, prog_name):
-    """ Try to import a module and class directly instead of the typical
-        Python method. Allows for dynamic imports. """
-    finder = importlib.machinery.PathFinder()
-    # unfortunately this does not support Posix paths and silently fails
-    # this is a standard lib function...
-    module_specs = finder.find_spec(str(ctrl_name), [str(ctrl_dir)])
-    module = module_specs.loader.load_module()
-    return getattr(module, prog_name)
+def get_caches(out_dir):
+    """ Returns the translation and the bytecode cache of an output folder.
+        The cache objects are kept, so they can track their size. """
+    out_dir = Path(out_dir).resolve()
+    if out_dir not in CACHES:
+        CACHES[out_dir] = (
+            TranslationCache(out_dir.joinpath(TRANSLATION_CACHE_NAME)),
+            TranslationCache(out_dir.joinpath(BYTECODE_CACHE_NAME),
+                             suffix=".marshal"))
+    return CACHES[out_dir]
 
 
-def get_z3_asts(p4_module, p4_path):
+def compile_ir(ir_source, ir_path, cache=None):
+    """ Compile the Python IR to a code object. If there is a cache, the
+        marshalled bytecode is cached by source hash, marshal is specific
+        to the interpreter version, so the version is part of the key. """
+    ir_key = get_query_key(sys.implementation.cache_tag, ir_source)
+    code = LOADED_IR.pop(ir_key, None)
+    if code is None:
+        bytecode = cache.get_data(ir_key) if cache else None
+        try:
+            code = marshal.loads(bytecode) if bytecode else None
+        except (EOFError, ValueError, TypeError):
+            log.warning("Discarding corrupt bytecode for %s.", ir_path)
+            code = None
+        if code is None:
+            code = compile(ir_source, str(ir_path), "exec")
+            if cache:
+                cache.put_data(ir_key, marshal.dumps(code))
+    # dicts keep insertion order, so the first key is the least recently used
+    LOADED_IR[ir_key] = code
+    if len(LOADED_IR) > MAX_LOADED_IR:
+        del LOADED_IR[next(iter(LOADED_IR))]
+    return code
+
+
+def import_prog(ir_source, ir_path, prog_name, cache=None):
+    """ Execute the Python IR in its own namespace and return the requested
+        object. The program never enters sys.modules, so long-running
+        processes do not accumulate one module per validated pass. """
+    code = compile_ir(ir_source, ir_path, cache)
+    namespace = {
+        "__name__": f"p4z3_ir_{Path(ir_path).stem}",
+        "__file__": str(ir_path),
+        "__builtins__": builtins,
+    }
+    exec(code, namespace)
+    return namespace[prog_name]
+
+
+def get_z3_asts(p4_module, p4_path, pipe_workers=1, pipe_names=None,
+                timer=None):
 
     log.info("Loading %s ASTs...", p4_path.name)
+    if timer is None:
+        timer = PhaseTimer()
     z3_asts = None
     try:
         prog_ctx = StaticContext()
+        prog_ctx.pipe_workers = pipe_workers
+        # pipes that are not listed are only interpreted on first access
+        prog_ctx.pipe_names = pipe_names
         prog_ctx.add_extern_extensions(core_externs)
-        p4_package = p4_module(prog_ctx)
+        # this includes the interpretation of all eagerly evaluated pipes
+        with timer.phase("construction"):
+            p4_package = p4_module(prog_ctx)
         if not p4_package:
             log.warning("No main module, nothing to evaluate!")
             return z3_asts, util.EXIT_SKIPPED
@@ -50,14 +115,28 @@ def get_z3_asts(p4_module, p4_path):
     return z3_asts, util.EXIT_SUCCESS
 
 
-def get_py_module(prog_path):
-    ctrl_dir = prog_path.parent
-    ctrl_name = prog_path.stem
+def get_package_pipes(package, pipe_names=None):
+    """ Interpret the requested pipes of a package, all of them if pipe_names
+        is None, and return them with an exit code. Pipes are interpreted on
+        first access, so this is where their translation errors surface. """
+    if pipe_names is None:
+        pipe_names = list(package.get_pipes())
+    try:
+        return package.get_pipes(pipe_names), util.EXIT_SUCCESS
+    except Exception:
+        log.exception("Failed to compile Python to Z3:\n")
+        return None, util.EXIT_FAILURE
+
+
+def get_py_module(prog_path, ir_source=None, cache=None):
     ctrl_function = "p4_program"
     try:
-        ctrl_module = import_prog(ctrl_dir, ctrl_name, ctrl_function)
-    except (ImportError, SyntaxError) as e:
-        log.error(("Could not import the " "requested module: %s", e))
+        if ir_source is None:
+            ir_source = prog_path.read_text()
+        ctrl_module = import_prog(ir_source, prog_path, ctrl_function,
+                                  cache)
+    except (OSError, ImportError, SyntaxError, KeyError) as e:
+        log.error("Could not import the requested module: %s", e)
         return None
     return ctrl_module
 
@@ -69,22 +148,54 @@ def run_p4_to_py(p4_file, py_file):
     return util.exec_process(cmd)
 
 
-def get_z3_formulization(p4_file, out_dir=OUT_DIR):
+def translate_p4_to_py(p4_file, py_file, cache=None):
+    cache_key = None
+    if cache:
+        cache_key = get_translation_key(p4_file, P4Z3_BIN, [P4_INCLUDE_DIR])
+        if cache.get(cache_key, py_file):
+            log.info("Reusing cached translation of %s.", p4_file.name)
+            return util.EXIT_SUCCESS
+    result = run_p4_to_py(p4_file, py_file)
+    if result.returncode != util.EXIT_SUCCESS:
+        return result.returncode
+    if cache:
+        cache.put(cache_key, py_file)
+    return util.EXIT_SUCCESS
+
 
+def get_z3_formulization(p4_file, out_dir=OUT_DIR, use_cache=False,
+                         pipe_workers=1, pipe_names=None, timer=None):
+
+    if timer is None:
+        timer = PhaseTimer()
+    translation_cache, bytecode_cache = None, None
+    if use_cache:
+        translation_cache, bytecode_cache = get_caches(out_dir)
+    if p4_file.suffix == SEMANTICS_SUFFIX:
+        # these semantics were already computed and dumped before
+        try:
+            with timer.phase("load"):
+                return load_semantics(p4_file), util.EXIT_SUCCESS
+        except (OSError, ValueError, KeyError, z3.Z3Exception) as e:
+            log.error("Failed to load semantics from %s: %s", p4_file, e)
+            return None, util.EXIT_FAILURE
     if p4_file.suffix == ".p4":
         util.check_dir(out_dir)
         py_file = out_dir.joinpath(p4_file.with_suffix(".py").name)
-        result = run_p4_to_py(p4_file, py_file)
+        with timer.phase("translation"):
+            result = translate_p4_to_py(p4_file, py_file, translation_cache)
         p4_file = py_file
-        if result.returncode != util.EXIT_SUCCESS:
+        if result != util.EXIT_SUCCESS:
             log.error("Failed to translate P4 to Python.")
             log.error("Compiler crashed!")
-            return None, result.returncode
+            return None, result
 
-    p4py_module = get_py_module(p4_file)
+    with timer.phase("import"):
+        p4py_module = get_py_module(p4_file, cache=bytecode_cache)
     if p4py_module is None:
         return None, util.EXIT_FAILURE
-    package, result = get_z3_asts(p4py_module, p4_file)
+    package, result = get_z3_asts(p4py_module, p4_file, pipe_workers,
+                                  pipe_names, timer)
     if result != util.EXIT_SUCCESS:
         return None, result
     return package, result
@@ -93,7 +204,7 @@ def get_z3_formulization(p4_file, out_dir=OUT_DIR):
 def get_flat_members(names):
     flat_members = []
     for name, p4z3_obj in names:
-        if isinstance(p4z3_obj, P4ComplexType):
+        if isinstance(p4z3_obj, (P4ComplexType, StoredType)):
             for sub_member in p4z3_obj.flat_names:
                 flat_members.append(f"{name}.{sub_member.name}")
         else:
@@ -103,63 +214,141 @@ def get_flat_members(names):
 
 def reconstruct_input(pipe_name, p4_state, pipe_cls):
     # these names are not quite accurate
+    if isinstance(p4_state, StoredState):
+        # loaded semantics carry the inputs they were evaluated with
+        return p4_state.inputs
     if isinstance(pipe_cls, P4Extern):
         initial_state = z3.Const(f"{pipe_name}", pipe_cls.z3_type)
-    else:
-        prog_ctx = StaticContext()
-        p4_state.initialize(prog_ctx)
-        initial_state = p4_state.get_z3_repr(prog_ctx)
+        return initial_state.children()
+    # the state still knows the inputs it was initialized with
+    return p4_state.get_z3_inputs()
 
-    inital_inputs = initial_state.children()
-    return inital_inputs
 
+def iter_pipe_paths(z3_expr):
+    """ Lazily enumerate the leaves of nested if-then-else expressions.
+        Yields the list of branch conditions and the leaf expression. The
+        formula is walked with an explicit stack, so deep nesting is fine. """
+    stack = [(z3_expr, [])]
+    while stack:
+        z3_expr, conds = stack.pop()
+        if z3.z3util.is_app_of(z3_expr, z3.Z3_OP_ITE):
+            cond, then_expr, else_expr = z3_expr.children()
+            # push the else branch first so that we visit the then branch first
+            stack.append((else_expr, conds + [z3.Not(cond)]))
+            stack.append((then_expr, conds + [cond]))
+        else:
+            yield conds, z3_expr
 
-def handle_nested_ifs(pipe_name, flat_members, inputs, outputs):
-    cond = outputs[0]
-    then_outputs = outputs[1].children()
-    else_outputs = outputs[2].children()
-    if z3.z3util.is_app_of(outputs[1], z3.Z3_OP_ITE):
-        handle_nested_ifs(pipe_name, flat_members, inputs, then_outputs)
-    else:
-        zipped_list = zip(flat_members, inputs, then_outputs)
-        table = tabulate(zipped_list, headers=["NAME", "INPUT", "OUTPUT"])
-        log.info("PIPE %s Condition:\n\"%s\"\n%s\n", pipe_name, cond, table)
-        zipped_list = zip(flat_members, inputs, then_outputs)
 
-    if z3.z3util.is_app_of(outputs[2], z3.Z3_OP_ITE):
-        handle_nested_ifs(pipe_name, flat_members, inputs, else_outputs)
-    else:
-        zipped_list = zip(flat_members, inputs, else_outputs)
-        table = tabulate(zipped_list, headers=["NAME", "INPUT", "OUTPUT"])
-        log.info("PIPE %s Condition:\n\"%s\"\n%s\n", pipe_name, z3.Not(cond),
-                 table)
-        zipped_list = zip(flat_members, inputs, else_outputs)
+def get_leaf_outputs(z3_leaf):
+    z3_sort = z3_leaf.sort()
+    if isinstance(z3_sort, z3.DatatypeSortRef):
+        constructor = z3_sort.constructor(0)
+        if not z3.is_app(z3_leaf) or z3_leaf.decl() != constructor:
+            # the leaf is a plain variable, e.g., the unmodified input
+            return [z3.simplify(z3_sort.accessor(0, idx)(z3_leaf))
+                    for idx in range(constructor.arity())]
+        return z3_leaf.children()
+    # simple expressions are their own single output
+    return [z3_leaf]
 
 
-def print_z3_data(pipe_name, pipe_val):
+def print_z3_data(pipe_name, pipe_val, timer=None, max_paths=MAX_PATHS,
+                  paths_file=None):
+    """ Print the input and output of every member for each path through the
+        pipe. Rows are emitted one at a time, either to the log or as json
+        lines to paths_file. At most max_paths paths are printed. """
     z3_datatype, p4_state, pipe_cls = pipe_val
-    z3_datatype = z3.simplify(z3_datatype)
+    if timer is None:
+        timer = PhaseTimer()
+    with timer.phase(pipe_name, group="simplify"):
+        z3_datatype = z3.simplify(z3_datatype)
     flat_members = get_flat_members(p4_state.members)
     inputs = reconstruct_input(pipe_name, p4_state, pipe_cls)
-    outputs = z3_datatype.children()
-    if z3.z3util.is_app_of(z3_datatype, z3.Z3_OP_ITE):
-        handle_nested_ifs(pipe_name, flat_members, inputs, outputs)
-    else:
-        zipped_list = zip(flat_members, inputs, outputs)
-        table = tabulate(zipped_list, headers=["NAME", "INPUT", "OUTPUT"])
-        log.info("PIPE %s:\n%s\n", pipe_name, table)
-    # log.info("%-20s %-20s %-20s" % ("NAME", "INPUT", "OUTPUT"))
-    # log.info("-" * 60)
-    # w = max([max(len(str(x)) for x in col) for col in zipped_list])
-    # zipped_list = zip(flat_members, inputs, outputs)
-    # for name, input, output in zipped_list:
-    #     row = f"{name: <{w}} {str(input): <{w}} {str(output): <{w}}"
-    #     log.info(row)
+    width = max([len(name) for name in flat_members] + [len("NAME")])
+    paths = iter_pipe_paths(z3_datatype)
+    if max_paths is not None:
+        # fetch one more path to know whether we cut off the output
+        paths = itertools.islice(paths, max_paths + 1)
+    for path_idx, (conds, z3_leaf) in enumerate(paths):
+        if max_paths is not None and path_idx == max_paths:
+            log.warning("PIPE %s has more than %s paths, stopping output.",
+                        pipe_name, max_paths)
+            break
+        if len(conds) > 1:
+            cond = z3.And(*conds)
+        else:
+            cond = conds[0] if conds else z3.BoolVal(True)
+        outputs = get_leaf_outputs(z3_leaf)
+        rows = zip(flat_members, inputs, outputs)
+        if paths_file:
+            for name, z3_input, z3_output in rows:
+                row = {"pipe": pipe_name, "path": path_idx,
+                       "condition": str(cond), "name": name,
+                       "input": str(z3_input), "output": str(z3_output)}
+                paths_file.write(json.dumps(row) + "\n")
+            continue
+        log.info("PIPE %s PATH %s Condition:\n\"%s\"", pipe_name, path_idx,
+                 cond)
+        log.info("%s %s %s", "NAME".ljust(width), "INPUT", "OUTPUT")
+        for name, z3_input, z3_output in rows:
+            log.info("%s %s %s", name.ljust(width), z3_input, z3_output)
+
+
+def get_pipe_inputs(pipes):
+    pipe_inputs = {}
+    for pipe_name, (_, p4_state, pipe_cls) in pipes.items():
+        if p4_state is not None:
+            pipe_inputs[pipe_name] = reconstruct_input(pipe_name, p4_state,
+                                                       pipe_cls)
+    return pipe_inputs
+
+
+def emit_semantics(package, out_file, pipe_names=None):
+    pipes = package.get_pipes(pipe_names)
+    dump_semantics(pipes, out_file, get_pipe_inputs(pipes))
+
+
+def get_served_formulization(p4_file, out_dir, use_cache=False,
+                             pipe_names=None, log_file=None):
+    # a running semantics server already has all the modules loaded
+    # returns None if there is no server, the caller does the work then
+    params = {
+        "p4_file": str(p4_file.resolve()),
+        "out_dir": str(out_dir.resolve()),
+        "use_cache": use_cache,
+        "pipe_names": pipe_names,
+    }
+    if log_file:
+        # the server appends the log of the request to our log file
+        params["log_file"] = str(Path(log_file).resolve())
+    response = util.call_server("get_z3_formulization", params)
+    if response is None:
+        return None
+    result = response["result"]
+    if result != util.EXIT_SUCCESS:
+        return None, result
+    log.info("Retrieved semantics of %s from the server.", p4_file)
+    return StoredPackage(deserialize_pipes(response["semantics"])), result
 
 
 def main(args):
+    out_dir = Path(args.out_dir)
+    profile_dir = out_dir if args.profile else None
+    timer = PhaseTimer(profile_dir, prefix=args.p4_input.stem)
     start_time = datetime.now()
-    package, result = get_z3_formulization(args.p4_input, Path(args.out_dir))
+    served = None
+    if not args.no_server:
+        served = get_served_formulization(args.p4_input, out_dir,
+                                          args.cache, args.pipe_names,
+                                          args.log_file)
+    if served is not None:
+        package, result = served
+    else:
+        package, result = get_z3_formulization(args.p4_input, out_dir,
+                                               args.cache,
+                                               args.pipe_workers,
+                                               args.pipe_names, timer)
     done_time = datetime.now()
     elapsed = done_time - start_time
     time_str = time.strftime("%H hours %M minutes %S seconds",
@@ -167,8 +356,28 @@ def main(args):
     ms = elapsed.microseconds / 1000
     log.info("Retrieving semantics took %s %s milliseconds.", time_str, ms)
     if result == util.EXIT_SUCCESS:
-        for pipe_name, pipe_val in package.get_pipes().items():
-            print_z3_data(pipe_name, pipe_val)
+        pipes, result = get_package_pipes(package, args.pipe_names)
+    if result == util.EXIT_SUCCESS and args.emit_semantics:
+        emit_semantics(package, args.emit_semantics, args.pipe_names)
+    if result == util.EXIT_SUCCESS:
+        paths_file = None
+        if args.paths_file:
+            paths_file = open(args.paths_file, "w")
+        try:
+            for pipe_name, pipe_val in pipes.items():
+                print_z3_data(pipe_name, pipe_val, timer, args.max_paths,
+                              paths_file)
+        finally:
+            if paths_file:
+                paths_file.close()
+        # lazy pipes are interpreted by now, so all timings are known
+        pipe_timings = getattr(package.get_pipes(), "timings", {})
+        for pipe_name, pipe_time in pipe_timings.items():
+            timer.add(pipe_name, pipe_time, group="interpretation")
+    util.check_dir(out_dir)
+    json_name = out_dir.joinpath(f"{args.p4_input.stem}_timing.json")
+    timer.dump(json_name, input_file=str(args.p4_input), exit_code=result,
+               total=elapsed.total_seconds())
     return result
 
 
@@ -180,12 +389,62 @@ if __name__ == '__main__':
                         default=None,
                         type=lambda x: util.is_valid_file(parser, x),
                         help="The main input p4 file. This can either be a P4"
-                        " program or the Python ToZ3 IR.")
+                        " program, the Python ToZ3 IR, or dumped semantics.")
     parser.add_argument("-o",
                         "--out_dir",
                         dest="out_dir",
                         default=OUT_DIR,
                         help="Where intermediate output is stored.")
+    parser.add_argument("-e",
+                        "--emit_semantics",
+                        dest="emit_semantics",
+                        default=None,
+                        help="Dump the semantics of all pipes to this file. "
+                        "Every tool that takes a P4 program also accepts "
+                        "this file instead.")
+    parser.add_argument("-j",
+                        "--pipe_workers",
+                        dest="pipe_workers",
+                        default=1,
+                        type=int,
+                        help="How many processes evaluate the pipes of the "
+                        "program in parallel.")
+    parser.add_argument("-P",
+                        "--pipe_names",
+                        dest="pipe_names",
+                        nargs="+",
+                        default=None,
+                        help="Only interpret these pipes instead of all "
+                        "pipes of the program.")
+    parser.add_argument("-m",
+                        "--max_paths",
+                        dest="max_paths",
+                        default=MAX_PATHS,
+                        type=int,
+                        help="The maximum number of paths printed per pipe.")
+    parser.add_argument("-f",
+                        "--paths_file",
+                        dest="paths_file",
+                        default=None,
+                        help="Write the paths of every pipe to this file as "
+                        "json lines instead of logging them.")
+    parser.add_argument("--profile",
+                        dest="profile",
+                        action="store_true",
+                        help="Run every phase under cProfile and dump the "
+                        "statistics to the output folder.")
+    parser.add_argument("-c",
+                        "--cache",
+                        dest="cache",
+                        action="store_true",
+                        help="Reuse cached translations of the P4 to Python "
+                        "translator and their compiled bytecode instead of "
+                        "always running both.")
+    parser.add_argument("--no_server",
+                        dest="no_server",
+                        action="store_true",
+                        help="Do not send the request to a running semantics "
+                        "server, always compute the semantics locally.")
     parser.add_argument("-l",
                         "--log_file",
                         dest="log_file",
@@ -1,4 +1,7 @@
 from collections import OrderedDict
+from collections.abc import Mapping
+import multiprocessing
+import time
 from p4z3.base import z3, log, copy
 from p4z3.base import P4Extern, StaticType
 from p4z3.state import LocalContext, P4State
@@ -20,11 +23,130 @@ def create_state_args(state_ctx, type_ctx, p4_params):
             state_ctx.set_or_add_var(param.name, instance)
     return state_args
 
+# the pipes forked workers evaluate, they inherit this list from the parent
+PIPE_JOBS = []
+# the constant we bind a pipe formula to when it leaves a worker
+PIPE_VAR = "p4z3_pipe"
+
+
+def apply_pipe(state_ctx, p4_state, pipe_val):
+    state_ctx.set_p4_state(p4_state)
+    # initialize the call with its own params we collected
+    # this is essentially the input packet
+    args = []
+    for param in pipe_val.params:
+        args.append(param.name)
+    pipe_val.apply(state_ctx, *args)
+    # after executing the pipeline get its z3 representation
+    return p4_state.create_z3_representation(state_ctx)
+
+
+def apply_pipe_job(job_idx):
+    # runs in a forked worker with its own copy of the program and z3 context
+    # z3 objects cannot be sent back, so we return the SMT-LIB2 instead
+    state_ctx, p4_state, pipe_val = PIPE_JOBS[job_idx]
+    start_time = time.perf_counter()
+    z3_function = apply_pipe(state_ctx, p4_state, pipe_val)
+    elapsed = time.perf_counter() - start_time
+    solver = z3.Solver()
+    solver.add(z3.Const(PIPE_VAR, z3_function.sort()) == z3_function)
+    return solver.to_smt2(), elapsed
+
+
+def apply_pipes_parallel(jobs, num_workers):
+    # fork so that every worker inherits the already interpreted program
+    PIPE_JOBS[:] = jobs
+    try:
+        fork_ctx = multiprocessing.get_context("fork")
+        with fork_ctx.Pool(min(num_workers, len(jobs))) as pool:
+            smt_pipes = pool.map(apply_pipe_job, range(len(jobs)))
+    finally:
+        PIPE_JOBS.clear()
+    z3_functions = []
+    for smt_pipe, elapsed in smt_pipes:
+        # the datatypes are matched by name, so the sort of the parsed
+        # expression is the same as the one of our own p4 state
+        z3_functions.append((z3.parse_smt2_string(smt_pipe)[0].arg(1),
+                             elapsed))
+    return z3_functions
+
+
+class LazyPipes(Mapping):
+    ''' The pipes of a package. A control pipe is only interpreted when it is
+    accessed for the first time, the result is kept afterwards. '''
+
+    def __init__(self):
+        self.pipes = OrderedDict()
+        # the controls that still need to be applied
+        self.jobs = {}
+        # the pipes of nested packages that have not been accessed yet
+        self.aliases = {}
+        self.num_workers = 1
+        # how many seconds the interpretation of each pipe took
+        self.timings = OrderedDict()
+
+    def add_pipe(self, pipe_name, pipe_val):
+        self.pipes[pipe_name] = pipe_val
+
+    def add_job(self, pipe_name, state_ctx, p4_state, pipe_val):
+        # keep the slot so the pipe order stays the same
+        self.pipes[pipe_name] = None
+        self.jobs[pipe_name] = (state_ctx, p4_state, pipe_val)
+
+    def add_alias(self, pipe_name, sub_pipes, sub_pipe_name):
+        self.pipes[pipe_name] = None
+        self.aliases[pipe_name] = (sub_pipes, sub_pipe_name)
+
+    def evaluate(self, pipe_names=None):
+        ''' Interpret the given pipes, or all of them if pipe_names is None.
+        Unknown names are ignored. '''
+        if pipe_names is None:
+            pipe_names = list(self.pipes)
+        for pipe_name in pipe_names:
+            if pipe_name in self.aliases:
+                sub_pipes, sub_pipe_name = self.aliases.pop(pipe_name)
+                self.pipes[pipe_name] = sub_pipes[sub_pipe_name]
+                if sub_pipe_name in sub_pipes.timings:
+                    self.timings[pipe_name] = sub_pipes.timings[sub_pipe_name]
+        pending = [name for name in pipe_names if name in self.jobs]
+        if not pending:
+            return
+        jobs = [self.jobs[pipe_name] for pipe_name in pending]
+        if self.num_workers > 1 and len(jobs) > 1:
+            log.info("Evaluating %s pipes with %s workers...",
+                     len(jobs), self.num_workers)
+            z3_functions = apply_pipes_parallel(jobs, self.num_workers)
+        else:
+            z3_functions = []
+            for state_ctx, p4_state, pipe_val in jobs:
+                start_time = time.perf_counter()
+                z3_function = apply_pipe(state_ctx, p4_state, pipe_val)
+                elapsed = time.perf_counter() - start_time
+                z3_functions.append((z3_function, elapsed))
+        for pipe_name, (z3_function, elapsed) in zip(pending, z3_functions):
+            _, p4_state, pipe_val = self.jobs.pop(pipe_name)
+            # all done, that is our P4 representation!
+            self.pipes[pipe_name] = (z3_function, p4_state, pipe_val)
+            self.timings[pipe_name] = elapsed
+
+    def __getitem__(self, pipe_name):
+        if pipe_name not in self.pipes:
+            raise KeyError(pipe_name)
+        self.evaluate([pipe_name])
+        return self.pipes[pipe_name]
+
+    def __iter__(self):
+        return iter(self.pipes)
+
+    def __len__(self):
+        return len(self.pipes)
+
+
 class P4Package(StaticType):
 
     def __init__(self, name, params, type_params):
         super(P4Package, self).__init__()
-        self.pipes = OrderedDict()
+        self.pipes = LazyPipes()
         self.name = name
         self.params = params
         self.type_params = type_params
@@ -71,42 +193,50 @@ class P4Package(StaticType):
 
     def initialize(self, ctx, *args, **kwargs):
         merged_args = merge_parameters(self.params, *args, **kwargs)
+        num_workers = ctx.master_ctx.pipe_workers
+        if multiprocessing.current_process().daemon:
+            # pool workers are not allowed to have children of their own
+            num_workers = 1
         for pipe_name, pipe_arg in merged_args.items():
             log.info("Loading %s pipe...", pipe_name)
             pipe_val = ctx.resolve_expr(pipe_arg.p4_val)
             if isinstance(pipe_val, P4Control):
                 # create the z3 representation of this control state
+                # type inference has to happen in order, so do it right away
+                # applying the control is deferred until the pipe is needed
                 state_ctx, p4_state = self.build_state_ctx(
                     ctx, pipe_name, pipe_arg, pipe_val)
-                state_ctx.set_p4_state(p4_state)
-                # initialize the call with its own params we collected
-                # this is essentially the input packet
-                args = []
-                for param in pipe_val.params:
-                    args.append(param.name)
-                pipe_val.apply(state_ctx, *args)
-                # after executing the pipeline get its z3 representation
-                z3_function = p4_state.create_z3_representation(state_ctx)
-                # all done, that is our P4 representation!
-                self.pipes[pipe_name] = (z3_function, p4_state, pipe_val)
+                self.pipes.add_job(pipe_name, state_ctx, p4_state, pipe_val)
             elif isinstance(pipe_val, P4Extern):
                 var = z3.Const(f"{pipe_name}{pipe_val.name}", pipe_val.z3_type)
-                self.pipes[pipe_name] = (var, None, pipe_val)
+                self.pipes.add_pipe(pipe_name, (var, None, pipe_val))
             elif isinstance(pipe_val, P4Package):
                 # execute the package by calling its initializer
                 # pipe_val.initialize(ctx)
                 # resolve all the sub_pipes
-                for sub_pipe_name, sub_pipe_val in pipe_val.pipes.items():
-                    sub_pipe_name = f"{pipe_name}_{sub_pipe_name}"
-                    self.pipes[sub_pipe_name] = sub_pipe_val
+                for sub_pipe_name in pipe_val.pipes:
+                    self.pipes.add_alias(f"{pipe_name}_{sub_pipe_name}",
+                                         pipe_val.pipes, sub_pipe_name)
             elif isinstance(pipe_val, z3.ExprRef):
                 # for some reason simple expressions are also possible.
-                self.pipes[pipe_name] = (pipe_val, None, pipe_val)
+                self.pipes.add_pipe(pipe_name, (pipe_val, None, pipe_val))
             else:
                 raise RuntimeError(
                     f"Unsupported value {pipe_val}, type {type(pipe_val)}."
                     " It does not make sense as a P4 pipeline.")
+        self.pipes.num_workers = num_workers
+        # interpret the requested pipes right away, the others on first access
+        # without a request all pipes are lazy, see get_package_pipes
+        if ctx.master_ctx.pipe_names is not None:
+            self.pipes.evaluate(ctx.master_ctx.pipe_names)
         return self
 
-    def get_pipes(self):
-        return self.pipes
+    def get_pipes(self, pipe_names=None):
+        ''' Returns the lazy mapping of all pipes or, if pipe_names is given,
+        a dict with only those pipes, which are interpreted together. '''
+        if pipe_names is None:
+            return self.pipes
+        self.pipes.evaluate(pipe_names)
+        return OrderedDict((pipe_name, self.pipes[pipe_name])
+                           for pipe_name in pipe_names
+                           if pipe_name in self.pipes)
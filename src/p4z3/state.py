@@ -180,6 +180,10 @@ class StaticContext(P4Context):
         self.master_ctx = self
         self.p4_state = None
         self.parent_ctx = None
+        # how many processes may evaluate the pipes of a package at once
+        self.pipe_workers = 1
+        # the pipes a package interprets eagerly, None means all of them
+        self.pipe_names = None
 
     def add_extern_extensions(self, extern_extensions):
         self.extern_extensions = {
@@ -431,6 +435,15 @@ class P4State():
             ctx.set_or_add_var(
                 arg_name, member_constructor(self.const), True)
 
+    def get_z3_inputs(self):
+        ''' The symbolic input of every flat member as bound by initialize.
+        These are the free variables of the pipe formula. '''
+        inputs = []
+        for type_idx in range(len(self.flat_names)):
+            member_constructor = self.z3_type.accessor(0, type_idx)
+            inputs.append(member_constructor(self.const))
+        return inputs
+
     def get_members(self, ctx):
         ''' This method returns the current representation of the object in z3
         logic. This function has a side-effect, validity may be modified.'''
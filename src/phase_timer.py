@@ -0,0 +1,58 @@
+import cProfile
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class PhaseTimer():
+    ''' Records the wall time of the named phases of a run. Phases can be
+    nested under a group, e.g., one entry per pipe. If a profile directory is
+    given, every phase is also run under cProfile and its statistics are
+    dumped to <prefix>_<phase>.pstats in that directory. '''
+
+    def __init__(self, profile_dir=None, prefix="phase"):
+        self.timings = OrderedDict()
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.prefix = prefix
+
+    @contextmanager
+    def phase(self, name, group=None):
+        profiler = None
+        if self.profile_dir:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            if profiler:
+                profiler.disable()
+                self._dump_profile(profiler, name, group)
+            self.add(name, elapsed, group)
+
+    def add(self, name, elapsed, group=None):
+        timings = self.timings
+        if group:
+            timings = self.timings.setdefault(group, OrderedDict())
+        # phases that run more than once accumulate their time
+        timings[name] = timings.get(name, 0.0) + elapsed
+
+    def _dump_profile(self, profiler, name, group):
+        phase_name = f"{group}_{name}" if group else name
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stats_file = self.profile_dir.joinpath(
+            f"{self.prefix}_{phase_name}.pstats")
+        profiler.dump_stats(str(stats_file))
+        log.debug("Dumped profile of phase %s to %s.", phase_name, stats_file)
+
+    def dump(self, json_name, **extra_info):
+        report = {**extra_info, "phases": self.timings}
+        log.info("Dumping timing report to %s.", json_name)
+        with open(json_name, "w") as json_file:
+            json.dump(report, json_file, indent=2)
@@ -0,0 +1,133 @@
+import json
+import logging
+from collections import OrderedDict, namedtuple
+
+import z3
+
+from p4z3.state import P4ComplexType
+
+log = logging.getLogger(__name__)
+
+# bump this whenever the layout of the semantics file changes
+SEMANTICS_VERSION = 1
+SEMANTICS_SUFFIX = ".json"
+# the constant we bind the serialized expressions to
+PIPE_VAR = "p4z3_pipe"
+
+StoredName = namedtuple("StoredName", ["name"])
+
+
+class StoredType():
+    ''' The flattened member names of a complex type in a loaded pipe. '''
+
+    def __init__(self, flat_names):
+        self.flat_names = [StoredName(name) for name in flat_names]
+
+
+class StoredState():
+    ''' Stand-in for the P4State of a loaded pipe. It only carries the member
+    names the tools need to print and slice a pipe formula and the inputs the
+    formula was evaluated with. '''
+
+    def __init__(self, name, members, inputs):
+        self.name = name
+        self.members = members
+        self.inputs = inputs
+
+
+class StoredPackage():
+    ''' Stand-in for a P4Package whose pipes were loaded from a file. '''
+
+    def __init__(self, pipes):
+        self.pipes = pipes
+
+    def get_pipes(self, pipe_names=None):
+        if pipe_names is None:
+            return self.pipes
+        return OrderedDict((pipe_name, self.pipes[pipe_name])
+                           for pipe_name in pipe_names
+                           if pipe_name in self.pipes)
+
+
+def serialize_exprs(z3_exprs):
+    # SMT-LIB2 has no notion of a bare term, so we bind every expression to a
+    # constant, the script also carries all sort and datatype declarations
+    solver = z3.Solver()
+    for idx, z3_expr in enumerate(z3_exprs):
+        solver.add(z3.Const(f"{PIPE_VAR}{idx}", z3_expr.sort()) == z3_expr)
+    return solver.to_smt2()
+
+
+def deserialize_exprs(smt_script):
+    assertions = z3.parse_smt2_string(smt_script)
+    # the right-hand side of each binding is the actual expression
+    return [assertion.arg(1) for assertion in assertions]
+
+
+def serialize_members(p4_state):
+    members = []
+    for name, p4z3_obj in p4_state.members:
+        if isinstance(p4z3_obj, (P4ComplexType, StoredType)):
+            sub_names = [sub_member.name for sub_member in p4z3_obj.flat_names]
+            members.append([name, sub_names])
+        else:
+            members.append([name, None])
+    return members
+
+
+def serialize_pipes(pipes, pipe_inputs=None):
+    ''' Convert the pipes of a package into a json-compatible dict.
+    pipe_inputs optionally maps a pipe name to its list of input expressions.
+    '''
+    pipe_inputs = pipe_inputs or {}
+    stored_pipes = OrderedDict()
+    for pipe_name, (z3_prog, p4_state, _) in pipes.items():
+        stored_pipe = {}
+        stored_pipe["formula"] = serialize_exprs([z3_prog])
+        if p4_state is not None:
+            stored_pipe["state"] = p4_state.name
+            stored_pipe["members"] = serialize_members(p4_state)
+        inputs = pipe_inputs.get(pipe_name)
+        if inputs is not None:
+            stored_pipe["inputs"] = serialize_exprs(inputs)
+        stored_pipes[pipe_name] = stored_pipe
+    return {"version": SEMANTICS_VERSION, "pipes": stored_pipes}
+
+
+def deserialize_pipes(semantics):
+    version = semantics.get("version")
+    if version != SEMANTICS_VERSION:
+        raise ValueError(f"Unsupported semantics version {version}, "
+                         f"expected {SEMANTICS_VERSION}.")
+    pipes = OrderedDict()
+    for pipe_name, stored_pipe in semantics["pipes"].items():
+        z3_prog = deserialize_exprs(stored_pipe["formula"])[0]
+        p4_state = None
+        if "members" in stored_pipe:
+            members = []
+            for name, sub_names in stored_pipe["members"]:
+                if sub_names is None:
+                    members.append((name, None))
+                else:
+                    members.append((name, StoredType(sub_names)))
+            inputs = None
+            if "inputs" in stored_pipe:
+                inputs = deserialize_exprs(stored_pipe["inputs"])
+            p4_state = StoredState(stored_pipe["state"], members, inputs)
+        pipes[pipe_name] = (z3_prog, p4_state, None)
+    return pipes
+
+
+def dump_semantics(pipes, out_file, pipe_inputs=None):
+    log.info("Dumping pipe semantics to %s.", out_file)
+    with open(out_file, "w") as json_file:
+        json.dump(serialize_pipes(pipes, pipe_inputs), json_file, indent=2)
+
+
+def load_semantics(in_file):
+    ''' Load a file written by dump_semantics.
+    Returns a package object that provides get_pipes(). '''
+    log.info("Loading pipe semantics from %s.", in_file)
+    with open(in_file, "r") as json_file:
+        semantics = json.load(json_file)
+    return StoredPackage(deserialize_pipes(semantics))
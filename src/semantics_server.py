@@ -0,0 +1,282 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import traceback
+from concurrent.futures import Future
+from pathlib import Path
+
+import z3
+
+# these imports are the reason this server exists
+# the fork server preloads this module and with it all of its imports, so
+# every worker starts with them
+import util
+import check_p4_pair as z3check
+import validate_p4_translation as validation
+from get_semantics import get_z3_formulization, get_pipe_inputs
+from get_semantics import get_package_pipes
+from pipe_semantics import serialize_pipes
+from verdict_cache import VerdictCache, CACHE_NAME
+from task_scheduler import TaskScheduler
+from task_scheduler import TASK_DONE, TASK_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+NUM_PROCESSES = os.cpu_count()
+# a live server answers a ping right away
+PING_TIMEOUT = 5
+# how often the dispatcher looks for new requests while others are running
+POLL_INTERVAL = 0.1
+
+
+def rpc_get_z3_formulization(params):
+    p4_file = Path(params["p4_file"])
+    out_dir = Path(params.get("out_dir", validation.PASS_DIR))
+    package, result = get_z3_formulization(p4_file, out_dir,
+                                           params.get("use_cache", False),
+                                           pipe_names=params.get("pipe_names"))
+    semantics = None
+    if result == util.EXIT_SUCCESS:
+        pipes, result = get_package_pipes(package, params.get("pipe_names"))
+    if result == util.EXIT_SUCCESS:
+        # z3 objects do not leave this process, so we send SMT-LIB2 instead
+        # clients can read this with pipe_semantics.deserialize_pipes
+        semantics = serialize_pipes(pipes, get_pipe_inputs(pipes))
+    return {"result": result, "semantics": semantics}
+
+
+def rpc_check_equivalence(params):
+    prog_paths = [Path(prog) for prog in params["progs"]]
+    fail_dir = params.get("fail_dir")
+    if fail_dir:
+        fail_dir = Path(fail_dir)
+    cache = None
+    if params.get("cache_dir"):
+        cache = VerdictCache(Path(params["cache_dir"]).joinpath(CACHE_NAME))
+    result, info = z3check.z3_check(
+        prog_paths, fail_dir, params.get("allow_undef", False),
+        params.get("bisect", False), cache, params.get("check_opts"))
+    return {"result": result, "info": info}
+
+
+def rpc_validate_translation(params):
+    result = validation.validate_translation(
+        Path(params["p4_file"]), Path(params["target_dir"]),
+        params.get("p4c_bin", validation.P4C_BIN),
+        params.get("allow_undef", False), params.get("dump_info", False),
+        params.get("bisect", False), params.get("cache_dir"),
+        params.get("check_opts"))
+    return {"result": result}
+
+
+RPC_METHODS = {
+    "get_z3_formulization": rpc_get_z3_formulization,
+    "check_equivalence": rpc_check_equivalence,
+    "validate_translation": rpc_validate_translation,
+}
+
+
+def init_worker(log_file, log_level, request_timeout):
+    # workers start from the fork server, give them the setup of main
+    logging.basicConfig(filename=log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, log_level),
+                        filemode="a")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    if request_timeout:
+        # solver queries without a budget of their own give up before the
+        # scheduler has to kill the whole request
+        z3.set_param("timeout", request_timeout * 1000)
+
+
+def handle_request(task):
+    # this runs in one of the warm worker processes
+    _, method, params = task
+    # every request may log to the log file of its client, the client has
+    # the file open already, so append to it
+    with util.log_to_file(params.get("log_file"), mode="a"):
+        try:
+            return RPC_METHODS[method](params)
+        except Exception:
+            return {"error": traceback.format_exc()}
+
+
+def get_response(task_result):
+    if task_result.status == TASK_DONE:
+        return task_result.value
+    if task_result.status == TASK_TIMEOUT:
+        return {"error": "Request timed out after "
+                f"{task_result.elapsed:.0f} seconds."}
+    if task_result.value:
+        return {"error": task_result.value}
+    return {"error": f"Request {task_result.status}."}
+
+
+class RequestDispatcher():
+    ''' Runs the requests of all connections on a TaskScheduler. Its
+    workers are not daemonic, so requests can start their own processes for
+    portfolio, fieldwise, and parallel undefined behavior checks. A request
+    that exceeds request_timeout is killed with its worker and all the
+    tools it started. The scheduler is not thread-safe, so a single thread
+    owns it and the connection threads hand their requests to it. '''
+
+    def __init__(self, num_workers, request_timeout, log_file=None,
+                 log_level="INFO"):
+        self.scheduler = TaskScheduler(
+            handle_request, num_workers, request_timeout,
+            initializer=init_worker,
+            initargs=(log_file, log_level, request_timeout))
+        self.requests = queue.Queue()
+        self.request_ids = itertools.count()
+        self.futures = {}
+        self.running = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.scheduler.start()
+        self.running = True
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.scheduler.close()
+
+    def submit(self, method, params):
+        ''' Returns a Future that receives the response of the request. '''
+        future = Future()
+        self.requests.put(((next(self.request_ids), method, params), future))
+        return future
+
+    def _run(self):
+        pending = []
+        while self.running:
+            while True:
+                try:
+                    pending.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            while pending and self.scheduler.has_idle():
+                task, future = pending.pop(0)
+                self.futures[task[0]] = future
+                self.scheduler.submit(task)
+            if not self.scheduler.num_busy():
+                # nothing to collect, wait for the next request instead
+                try:
+                    pending.append(self.requests.get(timeout=POLL_INTERVAL))
+                except queue.Empty:
+                    pass
+                continue
+            for task_result in self.scheduler.collect(POLL_INTERVAL):
+                future = self.futures.pop(task_result.task[0])
+                future.set_result(get_response(task_result))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        method = request.get("method")
+        params = request.get("params", {})
+        if method == "ping":
+            # used by clients to check whether the server is alive
+            response = {"result": util.EXIT_SUCCESS}
+        elif method not in RPC_METHODS:
+            response = {"error": f"Unknown method {method}!"}
+        else:
+            log.info("Handling request %s", method)
+            response = self.server.dispatcher.submit(method, params).result()
+        self.wfile.write(json.dumps(response).encode("utf-8"))
+
+
+class SemanticsServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, dispatcher):
+        self.dispatcher = dispatcher
+        super(SemanticsServer, self).__init__(str(socket_path),
+                                              RequestHandler)
+
+
+def main(args):
+    socket_path = Path(args.socket)
+    if socket_path.exists():
+        # a stale socket from a previous run, check whether it is alive
+        if util.call_server("ping", {}, socket_path, PING_TIMEOUT):
+            log.error("Server is already running on %s!", socket_path)
+            return util.EXIT_FAILURE
+        socket_path.unlink()
+
+    def signal_handler(sig, frame):
+        log.warning("Caught signal %s, shutting down...", sig)
+        sys.exit(util.EXIT_SUCCESS)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    dispatcher = RequestDispatcher(args.num_processes, args.request_timeout,
+                                   args.log_file, args.log_level)
+    dispatcher.start()
+    server = SemanticsServer(socket_path, dispatcher)
+    log.info("Serving %s with %s workers on %s",
+             list(RPC_METHODS), args.num_processes, socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        socket_path.unlink()
+        dispatcher.close()
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s",
+                        "--socket",
+                        dest="socket",
+                        default=util.SERVER_SOCKET,
+                        help="The unix socket the server listens on.")
+    parser.add_argument("-p",
+                        "--num_processes",
+                        dest="num_processes",
+                        default=NUM_PROCESSES,
+                        type=int,
+                        help="How many worker processes to keep warm.")
+    parser.add_argument("-t",
+                        "--request_timeout",
+                        dest="request_timeout",
+                        default=util.REQUEST_TIMEOUT,
+                        type=int,
+                        help="Abort a request after this many seconds.")
+    parser.add_argument("-l",
+                        "--log_file",
+                        dest="log_file",
+                        default="server.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log_level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode='w')
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    sys.exit(main(arguments))
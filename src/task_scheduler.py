@@ -0,0 +1,250 @@
+import os
+import signal
+import time
+import logging
+import traceback
+import multiprocessing
+from collections import namedtuple
+from multiprocessing.connection import wait
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+TASK_DONE = "done"
+TASK_ERROR = "error"
+TASK_TIMEOUT = "timeout"
+TASK_CRASHED = "crashed"
+
+# elapsed is the wall time the task ran for in seconds
+TaskResult = namedtuple("TaskResult", ["task", "status", "value", "elapsed"],
+                        defaults=[None])
+# marks the end of the task stream
+NO_TASK = object()
+# workers are started by a single-threaded fork server, forking the parent
+# directly is unsafe once it runs threads, e.g., the stages of the pipeline
+MP_CONTEXT = "forkserver"
+
+
+def get_child_pgids(pid):
+    # the tools a worker launches lead their own process groups, so killing
+    # the group of the worker misses them, find them through their parent
+    pgids = set()
+    for stat_file in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            stat = stat_file.read_text()
+        except OSError:
+            # the process is already gone
+            continue
+        # the command name may contain spaces, the fields start after it
+        fields = stat[stat.rindex(")") + 2:].split()
+        if int(fields[1]) == pid:
+            pgids.add(int(fields[2]))
+    return pgids
+
+
+def run_worker(func, conn, initializer, initargs):
+    # every worker leads its own process group, so that a hung task can be
+    # killed together with all the compilers and solvers it started
+    os.setpgid(0, 0)
+    if initializer:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            status, value = TASK_DONE, func(task)
+        except Exception:
+            status, value = TASK_ERROR, traceback.format_exc()
+        try:
+            conn.send((status, value))
+        except Exception:
+            # the result could not be pickled, at least report that
+            conn.send((TASK_ERROR, traceback.format_exc()))
+
+
+class Worker():
+    ''' A single worker process that runs one task at a time. '''
+
+    def __init__(self, mp_ctx, func, initializer=None, initargs=()):
+        self.conn, child_conn = mp_ctx.Pipe()
+        self.proc = mp_ctx.Process(target=run_worker,
+                                   args=(func, child_conn, initializer,
+                                         initargs))
+        self.proc.start()
+        child_conn.close()
+        self.task = None
+        self.start_time = None
+        self.deadline = None
+        self.num_tasks = 0
+
+    def assign(self, task, timeout):
+        self.task = task
+        self.start_time = time.monotonic()
+        self.deadline = self.start_time + timeout if timeout else None
+        self.conn.send(task)
+
+    def release(self, status, value):
+        result = TaskResult(self.task, status, value,
+                            time.monotonic() - self.start_time)
+        self.task = None
+        self.start_time = None
+        self.deadline = None
+        self.num_tasks += 1
+        return result
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.proc.join(timeout)
+        self.kill()
+
+    def kill(self):
+        if self.proc.is_alive():
+            try:
+                # freeze the worker so that it cannot launch new tools while
+                # we collect the groups of the running ones
+                os.killpg(self.proc.pid, signal.SIGSTOP)
+                pgids = get_child_pgids(self.proc.pid) - {self.proc.pid}
+                for pgid in pgids:
+                    try:
+                        os.killpg(pgid, signal.SIGKILL)
+                    except (ProcessLookupError, PermissionError):
+                        continue
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                # the worker has not set up its process group yet
+                self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+
+class TaskScheduler():
+    ''' Runs a function over a stream of tasks in a set of worker processes.
+    Unlike multiprocessing.Pool, the parent tracks which task every worker is
+    running. A task that exceeds its deadline is killed together with its
+    process group and the worker is replaced, as is a worker that crashed.
+    Workers are also replaced after max_tasks_per_child tasks to cap their
+    memory growth. Workers do not inherit the state of the parent, so func,
+    tasks, and results must be picklable and every new worker calls
+    initializer(*initargs) to set itself up, like with multiprocessing.Pool.
+    '''
+
+    def __init__(self, func, num_workers, task_timeout=None,
+                 max_tasks_per_child=None, initializer=None, initargs=()):
+        self.func = func
+        self.num_workers = num_workers
+        self.task_timeout = task_timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.initializer = initializer
+        self.initargs = initargs
+        self._mp_ctx = multiprocessing.get_context(MP_CONTEXT)
+        self._idle = []
+        self._busy = []
+
+    def _spawn(self):
+        return Worker(self._mp_ctx, self.func, self.initializer,
+                      self.initargs)
+
+    def _is_exhausted(self, worker):
+        if not self.max_tasks_per_child:
+            return False
+        return worker.num_tasks >= self.max_tasks_per_child
+
+    def start(self):
+        self._idle = [self._spawn() for _ in range(self.num_workers)]
+        self._busy = []
+
+    def close(self):
+        for worker in self._idle + self._busy:
+            worker.kill()
+        self._idle = []
+        self._busy = []
+
+    def has_idle(self):
+        return bool(self._idle)
+
+    def num_busy(self):
+        return len(self._busy)
+
+    def submit(self, task):
+        ''' Hands a task to an idle worker, check has_idle first. '''
+        worker = self._idle.pop()
+        worker.assign(task, self.task_timeout)
+        self._busy.append(worker)
+
+    def collect(self, timeout=None):
+        ''' Waits up to timeout seconds for running tasks to finish or exceed
+        their deadline. Returns the list of their TaskResults. '''
+        if not self._busy:
+            return []
+        deadlines = [w.deadline for w in self._busy if w.deadline]
+        if deadlines:
+            deadline_timeout = max(min(deadlines) - time.monotonic(), 0)
+            if timeout is None or deadline_timeout < timeout:
+                timeout = deadline_timeout
+        ready = wait([w.conn for w in self._busy] +
+                     [w.proc.sentinel for w in self._busy], timeout)
+        now = time.monotonic()
+        results = []
+        for worker in list(self._busy):
+            if worker.conn in ready or worker.proc.sentinel in ready:
+                result = self._collect(worker)
+            elif worker.deadline and now >= worker.deadline:
+                log.error("Task %s exceeded its deadline of %s "
+                          "seconds, killing its worker.",
+                          worker.task, self.task_timeout)
+                result = worker.release(TASK_TIMEOUT, None)
+                worker.kill()
+            else:
+                continue
+            self._busy.remove(worker)
+            if result.status in (TASK_TIMEOUT, TASK_CRASHED):
+                self._idle.append(self._spawn())
+            elif self._is_exhausted(worker):
+                log.debug("Recycling worker %s.", worker.proc.pid)
+                worker.stop()
+                self._idle.append(self._spawn())
+            else:
+                self._idle.append(worker)
+            results.append(result)
+        return results
+
+    def imap_unordered(self, tasks):
+        ''' Yields a TaskResult for every task as soon as it finishes. '''
+        tasks = iter(tasks)
+        has_tasks = True
+        self.start()
+        try:
+            while True:
+                while self.has_idle() and has_tasks:
+                    task = next(tasks, NO_TASK)
+                    if task is NO_TASK:
+                        has_tasks = False
+                        break
+                    self.submit(task)
+                if not self.num_busy():
+                    break
+                for result in self.collect():
+                    yield result
+        finally:
+            self.close()
+
+    def _collect(self, worker):
+        try:
+            if worker.conn.poll():
+                status, value = worker.conn.recv()
+                return worker.release(status, value)
+        except (EOFError, OSError):
+            pass
+        # the worker died before it could report a result
+        log.error("Worker %s crashed with exit code %s while running %s.",
+                  worker.proc.pid, worker.proc.exitcode, worker.task)
+        result = worker.release(TASK_CRASHED, None)
+        worker.kill()
+        return result
@@ -0,0 +1,152 @@
+import os
+import re
+import logging
+import tempfile
+from pathlib import Path
+
+from verdict_cache import get_query_key, get_file_key, get_bin_key
+
+log = logging.getLogger(__name__)
+
+# the maximum number of translations we keep before evicting old entries
+MAX_ENTRIES = 10000
+# how many entries a cache object writes before it recounts the folder
+EVICT_INTERVAL = 100
+# eviction trims the cache to this share of max_entries, so that a full
+# cache is not scanned again on the very next write
+LOW_WATER_MARK = 0.9
+# quoted includes are looked up next to the including file first
+LOCAL_INCLUDE_REGEX = re.compile(rb'^\s*#\s*include\s*"([^"]+)"',
+                                 re.MULTILINE)
+
+
+def get_local_includes(p4_file):
+    # the source file and every local file it includes, directly or not
+    p4_file = Path(p4_file)
+    closure = [p4_file]
+    seen = {p4_file.resolve()}
+    for src_file in closure:
+        with open(src_file, "rb") as f:
+            src = f.read()
+        for match in LOCAL_INCLUDE_REGEX.finditer(src):
+            include_file = src_file.parent.joinpath(os.fsdecode(match[1]))
+            # anything else comes from the include folders
+            if not include_file.is_file():
+                continue
+            if include_file.resolve() in seen:
+                continue
+            seen.add(include_file.resolve())
+            closure.append(include_file)
+    return closure
+
+
+def get_translation_key(p4_file, translator_bin, include_dirs=()):
+    # the translation depends on the program and its local includes, the
+    # translator, and the headers it pulls in, headers are identified by
+    # their stat like the binary
+    include_keys = []
+    for include_dir in include_dirs:
+        for include_file in sorted(Path(include_dir).glob("**/*.p4")):
+            include_keys.append(get_bin_key(include_file))
+    return get_query_key(get_file_key(*get_local_includes(p4_file)),
+                         get_bin_key(translator_bin), *include_keys)
+
+
+class TranslationCache():
+    ''' A content-addressed store of translation artifacts, by default the
+    Python IR files emitted by p4toz3. Every entry is a single file named
+    after its key. Entries are written atomically so that concurrent
+    processes can share the same folder. The modification time of an entry
+    is its last use. The folder is counted on the first write of a cache
+    object and again every evict_interval writes, in between the count is
+    estimated. Once it exceeds max_entries the least recently used entries
+    are deleted down to the low water mark. '''
+
+    def __init__(self, cache_dir, max_entries=MAX_ENTRIES, suffix=".py",
+                 evict_interval=EVICT_INTERVAL):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.suffix = suffix
+        self.evict_interval = evict_interval
+        self.num_puts = 0
+        # the number of entries on disk as of the last scan plus our writes
+        self.num_entries = None
+
+    def _get_entry(self, key):
+        return self.cache_dir.joinpath(f"{key}{self.suffix}")
+
+    def get(self, key, out_file):
+        ''' Copies a cached translation to out_file.
+        Returns True on a hit and False otherwise. '''
+        data = self.get_data(key)
+        if data is None:
+            return False
+        try:
+            Path(out_file).write_bytes(data)
+        except OSError:
+            return False
+        return True
+
+    def put(self, key, py_file):
+        try:
+            data = Path(py_file).read_bytes()
+        except OSError as e:
+            log.warning("Could not read translation %s: %s", py_file, e)
+            return
+        self.put_data(key, data)
+
+    def get_data(self, key):
+        ''' Returns the cached bytes or None. '''
+        entry = self._get_entry(key)
+        try:
+            data = entry.read_bytes()
+            # mark the entry as recently used
+            os.utime(entry)
+        except OSError:
+            return None
+        log.debug("Found cache entry %s", entry)
+        return data
+
+    def put_data(self, key, data):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so readers never see a partial
+            # entry, os.replace is atomic within the same file system
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_file, self._get_entry(key))
+            self.num_puts += 1
+            if self.num_entries is not None:
+                self.num_entries += 1
+            # scanning the folder is expensive, we only do it if we have no
+            # count yet, the cache may be full, or others may have written
+            if (self.num_entries is None or
+                    self.num_entries > self.max_entries or
+                    self.num_puts % self.evict_interval == 0):
+                self._evict()
+        except OSError as e:
+            # the cache is an optimization, never fail because of it
+            log.warning("Could not write to cache %s: %s", self.cache_dir, e)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.suffix):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    # another process evicted this entry already
+                    continue
+        self.num_entries = len(entries)
+        if self.num_entries <= self.max_entries:
+            return
+        overflow = self.num_entries - int(self.max_entries * LOW_WATER_MARK)
+        log.debug("Evicting %s entries from translation cache.", overflow)
+        self.num_entries -= overflow
+        entries.sort()
+        for _, entry in entries[:overflow]:
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
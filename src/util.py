@@ -1,7 +1,17 @@
 import os
+import atexit
+import json
+import resource
+import select
+import signal
+import socket
 import subprocess
 import shutil
+import threading
+import tempfile
+import time
 import logging as log
+from contextlib import contextmanager
 from pathlib import Path
 
 EXIT_SUCCESS = 0
@@ -10,6 +20,25 @@ EXIT_SKIPPED = 10
 EXIT_VIOLATION = 20
 EXIT_UNDEF = 30
 
+FILE_DIR = Path(__file__).parent.resolve()
+# the unix socket of the semantics server, see semantics_server.py
+SERVER_SOCKET = FILE_DIR.joinpath("../p4z3_server.sock")
+# the server aborts a request after this many seconds
+REQUEST_TIMEOUT = 3600
+# clients give up on the server if it does not answer in this many seconds
+SERVER_TIMEOUT = REQUEST_TIMEOUT + 60
+# limits for every external tool we launch, None means unlimited
+# see set_process_limits
+PROCESS_LIMITS = {"timeout": None, "memory": None, "cpu": None}
+# background processes launched by start_process that were not reaped yet
+BACKGROUND_PROCS = []
+# the stages of the fuzzing pipeline launch processes from several threads
+BACKGROUND_LOCK = threading.Lock()
+# how many seconds we wait for background processes when we exit
+STOP_GRACE_PERIOD = 60
+# how many seconds a process may take to exit after SIGTERM before we kill it
+KILL_GRACE_PERIOD = 5
+
 
 def is_valid_file(parser, arg):
     if not os.path.exists(arg):
@@ -55,8 +84,147 @@ def move_file(src, dst):
         shutil.move(src, dst)
 
 
+def get_limits_fn(preexec_fn=None):
+    # rlimits are per process, but the children of a tool inherit them
+    # so we set them in the child before it executes the tool
+    limits = []
+    if PROCESS_LIMITS["memory"]:
+        limits.append((resource.RLIMIT_AS, PROCESS_LIMITS["memory"]))
+    if PROCESS_LIMITS["cpu"]:
+        limits.append((resource.RLIMIT_CPU, PROCESS_LIMITS["cpu"]))
+    if not limits:
+        return preexec_fn
+
+    def set_limits():
+        # this runs between fork and exec, so keep it to system calls
+        for rlimit, limit in limits:
+            resource.setrlimit(rlimit, (limit, limit))
+        if preexec_fn:
+            preexec_fn()
+    return set_limits
+
+
+def set_process_limits(timeout=None, memory=None, cpu=None):
+    ''' Limits every tool launched by this process and its forked workers.
+    timeout is the wall-clock limit in seconds, memory the address space
+    limit in bytes, and cpu the cpu time limit in seconds. '''
+    PROCESS_LIMITS["timeout"] = timeout
+    PROCESS_LIMITS["memory"] = memory
+    PROCESS_LIMITS["cpu"] = cpu
+
+
+def get_popen_args(kwargs):
+    # every tool leads its own process group, so that we can kill it together
+    # with all the processes it started, callers may set up their own session
+    if "preexec_fn" not in kwargs and "start_new_session" not in kwargs:
+        kwargs["start_new_session"] = True
+    limits_fn = get_limits_fn(kwargs.get("preexec_fn"))
+    if limits_fn:
+        kwargs["preexec_fn"] = limits_fn
+    return kwargs
+
+
+def wait_process(proc, timeout=None):
+    ''' Waits for proc like Popen.wait, but reaps it with os.wait4 and keeps
+    its resource usage in proc.rusage. Unlike RUSAGE_CHILDREN this only
+    covers this tool and the children it waited for, also when other
+    threads launch tools. Raises subprocess.TimeoutExpired. '''
+    if proc.returncode is not None:
+        return proc.returncode
+    if timeout is not None:
+        # a pid file descriptor becomes readable once the process exits
+        pidfd = os.pidfd_open(proc.pid)
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+        finally:
+            os.close(pidfd)
+        if not ready:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+    try:
+        _, status, proc.rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # someone else reaped the process, we cannot get its status
+        proc.rusage = None
+        proc.returncode = 0
+        return proc.returncode
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode
+
+
+def kill_process_tree(proc, sig=signal.SIGKILL):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        # the process does not lead a group or is already gone
+        pass
+    if proc.returncode is not None:
+        # the process was reaped already, its pid may belong to another one
+        return
+    try:
+        # not proc.send_signal, that may reap the process behind our back
+        os.kill(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def reap_processes():
+    ''' Collects the exit status of finished background processes so they do
+    not linger as zombies. Returns the number of processes still running. '''
+    with BACKGROUND_LOCK:
+        for proc in list(BACKGROUND_PROCS):
+            if proc.poll() is not None:
+                log.debug("Background process %s exited with code %s.",
+                          proc.pid, proc.returncode)
+                BACKGROUND_PROCS.remove(proc)
+        return len(BACKGROUND_PROCS)
+
+
+def stop_processes(grace_period=None):
+    ''' Waits up to grace_period seconds for the remaining background
+    processes. The process trees of those still running are asked to
+    terminate and killed if they do not exit within KILL_GRACE_PERIOD.
+    Without a grace period this waits for all of them to finish. '''
+    deadline = None
+    if grace_period is not None:
+        deadline = time.monotonic() + grace_period
+    with BACKGROUND_LOCK:
+        procs = list(BACKGROUND_PROCS)
+    for proc in procs:
+        try:
+            if deadline is None:
+                proc.wait()
+            else:
+                proc.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            log.warning("Stopping background process %s: %s", proc.pid,
+                        proc.args)
+            kill_process_tree(proc, signal.SIGTERM)
+            try:
+                proc.wait(KILL_GRACE_PERIOD)
+            except subprocess.TimeoutExpired:
+                log.warning("Killing background process %s.", proc.pid)
+                kill_process_tree(proc)
+                proc.wait()
+        with BACKGROUND_LOCK:
+            if proc in BACKGROUND_PROCS:
+                BACKGROUND_PROCS.remove(proc)
+
+
+def get_rusage(rusage, elapsed):
+    usage = {"wall_time": elapsed}
+    if rusage is None:
+        # the process was reaped by someone else
+        return usage
+    usage["user_time"] = rusage.ru_utime
+    usage["sys_time"] = rusage.ru_stime
+    usage["max_rss_kb"] = rusage.ru_maxrss
+    return usage
+
+
 def start_process(cmd, *args, out_file=subprocess.PIPE, **kwargs):
     log.debug("Executing %s ", cmd)
+    reap_processes()
+    kwargs = get_popen_args(kwargs)
     if out_file is subprocess.STDOUT:
         proc = subprocess.Popen(cmd.split(), *args, **kwargs)
     elif out_file is subprocess.PIPE:
@@ -74,6 +242,8 @@ def start_process(cmd, *args, out_file=subprocess.PIPE, **kwargs):
                                     stderr=f_err,
                                     *args,
                                     **kwargs)
+    with BACKGROUND_LOCK:
+        BACKGROUND_PROCS.append(proc)
     return proc
 
 
@@ -82,18 +252,115 @@ def exec_process(cmd,
                  silent=False,
                  stdout=subprocess.PIPE,
                  stderr=subprocess.PIPE,
+                 timeout=None,
                  **kwargs):
     log.debug("Executing %s ", cmd)
-    result = subprocess.run(cmd.split(),
-                            *args,
-                            stdout=stdout,
-                            stderr=stderr,
-                            **kwargs)
+    reap_processes()
+    if timeout is None:
+        timeout = PROCESS_LIMITS["timeout"]
+    kwargs = get_popen_args(kwargs)
+    # the output goes to temporary files instead of pipes, so that we can
+    # wait for the tool ourselves without having to drain its output
+    out_files = {}
+    if stdout is subprocess.PIPE:
+        stdout = out_files["stdout"] = tempfile.TemporaryFile()
+    if stderr is subprocess.PIPE:
+        stderr = out_files["stderr"] = tempfile.TemporaryFile()
+    start_time = time.perf_counter()
+    try:
+        with subprocess.Popen(cmd.split(),
+                              *args,
+                              stdout=stdout,
+                              stderr=stderr,
+                              **kwargs) as proc:
+            try:
+                wait_process(proc, timeout)
+            except subprocess.TimeoutExpired:
+                log.error("Process %s exceeded %s seconds, killing it.", cmd,
+                          timeout)
+                kill_process_tree(proc)
+                wait_process(proc)
+            except BaseException:
+                # e.g., an alarm of the caller fired, do not leave orphans
+                kill_process_tree(proc)
+                wait_process(proc)
+                raise
+        outputs = {}
+        for name, out_file in out_files.items():
+            out_file.seek(0)
+            outputs[name] = out_file.read()
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+    out = outputs.get("stdout")
+    err = outputs.get("stderr")
+    result = subprocess.CompletedProcess(proc.args, proc.returncode, out, err)
+    result.rusage = get_rusage(getattr(proc, "rusage", None),
+                               time.perf_counter() - start_time)
+    log.debug("Resource usage of %s: %s", cmd, result.rusage)
     if result.stdout:
         log.debug("Process output: %s", result.stdout.decode("utf-8"))
     if result.returncode != EXIT_SUCCESS and not silent:
         log.error("BEGIN %s", 40 * "#")
         log.error("Failed while executing:\n%s\n", cmd)
-        log.error("Output:\n%s", result.stderr.decode("utf-8"))
+        # stderr is None if it was redirected to stdout
+        output = result.stderr if result.stderr is not None else result.stdout
+        log.error("Output:\n%s", output.decode("utf-8"))
         log.error("END %s", 40 * "#")
     return result
+
+
+@contextmanager
+def log_to_file(log_file, mode="w"):
+    ''' Sends all log records to log_file instead of the current handlers,
+    just like a fresh process with its own log file would. '''
+    if not log_file:
+        yield
+        return
+    root_log = log.getLogger()
+    handlers = root_log.handlers
+    file_log = log.FileHandler(log_file, mode=mode)
+    file_log.setFormatter(log.Formatter("%(levelname)s:%(message)s"))
+    root_log.handlers = [file_log]
+    try:
+        yield
+    finally:
+        root_log.handlers = handlers
+        file_log.close()
+
+
+def call_server(method, params, socket_path=SERVER_SOCKET,
+                timeout=SERVER_TIMEOUT):
+    # returns None if the server is not running or the request failed,
+    # callers should fall back to executing the request themselves
+    if not os.path.exists(socket_path):
+        return None
+    request = json.dumps({"method": method, "params": params}) + "\n"
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            sock.sendall(request.encode("utf-8"))
+            sock.shutdown(socket.SHUT_WR)
+            for chunk in iter(lambda: sock.recv(65536), b""):
+                chunks.append(chunk)
+    except OSError as e:
+        # this includes socket.timeout
+        log.warning("Could not reach server at %s: %s", socket_path, e)
+        return None
+    try:
+        response = json.loads(b"".join(chunks).decode("utf-8"))
+    except json.JSONDecodeError:
+        # the server went away before it could answer
+        log.warning("Server at %s sent no valid response to %s.",
+                    socket_path, method)
+        return None
+    if "error" in response:
+        log.error("Server request %s failed:\n%s", method, response["error"])
+        return None
+    return response
+
+
+# do not leave running background processes behind when we exit
+atexit.register(stop_processes, STOP_GRACE_PERIOD)
@@ -1,17 +1,22 @@
 import os
 import sys
+import csv
 import json
 import argparse
-import subprocess
+import re
+import mmap
 import logging
 import hashlib
 import time
+import subprocess
 from datetime import datetime
 
 from pathlib import Path
 
 import util
 import check_p4_pair as z3check
+from task_scheduler import TaskScheduler, TASK_DONE, TASK_TIMEOUT
+from verdict_cache import VerdictCache, CACHE_NAME
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +24,19 @@ FILE_DIR = Path(__file__).parent.resolve()
 P4C_BIN = FILE_DIR.joinpath("../modules/p4c/build/p4test")
 P4Z3_BIN = FILE_DIR.joinpath("../modules/p4c/build/p4toz3")
 PASS_DIR = FILE_DIR.joinpath("../validated")
+NUM_PROCESSES = os.cpu_count()
+# the maximum time in seconds we spend on a single file in corpus mode
+FILE_TIMEOUT = 600
+SUMMARY_NAME = "summary"
+SUMMARY_FIELDS = ["input_file", "status", "exit_code", "passes", "elapsed",
+                  "prog_before", "prog_after", "pass_before", "pass_after"]
+STATUS_NAMES = {
+    util.EXIT_SUCCESS: "success",
+    util.EXIT_FAILURE: "failure",
+    util.EXIT_SKIPPED: "skipped",
+    util.EXIT_VIOLATION: "violation",
+    util.EXIT_UNDEF: "undefined",
+}
 
 
 PASSES = "--top4 "
@@ -28,40 +46,63 @@ PASSES += "FrontEnd,MidEnd,PassManager "
 # passes with "::" in them are a little bit funky.. ignore those
 # this emits all passes, but that is too much right now...
 # PASSES += "\"^(?!.*::.*).*\" "
+# the verbose compiler output names a pass we dump on these lines
+PASS_REGEX = re.compile(r"FrontEnd|MidEnd|PassManager")
+# block comments are not part of the semantics of a pass
+COMMENT_REGEX = re.compile(rb"/\*.*?\*/", re.DOTALL)
+# dumps larger than this are memory-mapped when they are normalized
+MMAP_THRESHOLD = 1024 * 1024
 
 INFO = {"compiler": str(P4C_BIN),
         "exit_code": util.EXIT_SUCCESS,
         "prog_before": "",
         "prog_after": "",
+        "pass_before": "",
+        "pass_after": "",
         "p4z3_bin": str(P4Z3_BIN),
         "out_dir": str(PASS_DIR),
         "input_file": "",
         "allow_undef": False,
+        "bisect": False,
         "validation_bin": f"python3 {__file__}",
         "err_string": "",
         }
 
 
 def generate_p4_dump(p4c_bin, p4_file, p4_dmp_dir):
-    p4_cmd = f"{p4c_bin} "
+    # the verbose output lists every pass, so we do not need a second run
+    p4_cmd = f"{p4c_bin} -v "
     p4_cmd += f"{PASSES} "
     # p4_cmd += f"-o {p4_dmp_dir} "
     p4_cmd += f"--dump {p4_dmp_dir} {p4_file} "
     log.debug("Running dumps with command %s ", p4_cmd)
-    return util.exec_process(p4_cmd)
+    # the passes are listed on both streams, keep them in order
+    return util.exec_process(p4_cmd, stderr=subprocess.STDOUT)
+
+
+def normalize_pass(p4_file):
+    """ Return the content of a pass dump without comments and blank lines.
+        Large dumps are memory-mapped instead of being read into memory. """
+    with open(p4_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            content = f.read()
+            return normalize_content(content)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return normalize_content(content)
+
+
+def normalize_content(content):
+    content = COMMENT_REGEX.sub(b"", content)
+    lines = [line for line in content.splitlines() if line.strip()]
+    return b"\n".join(lines) + b"\n"
 
 
 def prune_files(p4_prune_dir, p4_passes):
     util.check_dir(p4_prune_dir)
     for p4_file in p4_passes:
-        sed_cmd = "sed -r "
-        sed_cmd += "\':a; s%(.*)/\\*.*\\*/%\\1%; ta; /\\/\\*/ !b; N; ba\' "
-        sed_cmd += f"{p4_file} "
-        sed_cmd += " | sed -r \'/^\\s*$/d\' "
-        sed_cmd += f"> {p4_prune_dir}/{p4_file.name}"
-        log.debug("Removing comments and whitespace")
-        log.debug("Command: %s", sed_cmd)
-        util.exec_process(sed_cmd)
+        log.debug("Removing comments and whitespace from %s", p4_file)
+        pruned_file = Path(p4_prune_dir).joinpath(p4_file.name)
+        pruned_file.write_bytes(normalize_pass(p4_file))
     return p4_prune_dir
 
 
@@ -98,64 +139,77 @@ def run_p4_to_py(p4_file, py_file):
     return util.exec_process(cmd)
 
 
-def list_passes(p4c_bin, p4_file, p4_dmp_dir):
-    p4_pass_cmd = f"{p4c_bin} -v "
-    # p4_pass_cmd += f"-o {p4_dmp_dir} "
-    p4_pass_cmd += f"{p4_file} 2>&1 "
-    # p4_pass_cmd += "| sed -e '/FrontEnd/!d' | "
-    p4_pass_cmd += "| sed -e '/FrontEnd\\|MidEnd\\|PassManager/!d' | "
-    p4_pass_cmd += "sed -e '/Writing program to/d' "
-    # p4_pass_cmd += "| grep 'Writing program to' "
-    # p4_pass_cmd += "| sed -e 's/Writing program to //g' "
-    log.debug("Grabbing passes with command %s", p4_pass_cmd)
-    output = subprocess.check_output(p4_pass_cmd, shell=True)
-    if output:
-        return output.decode('ascii').strip().split('\n')
+def list_passes(compiler_output):
+    # keep the lines that name one of the passes we dump
+    p4_passes = []
+    for line in compiler_output.splitlines():
+        line = line.strip()
+        if not PASS_REGEX.search(line):
+            continue
+        if line.startswith("Writing program to"):
+            continue
+        p4_passes.append(line)
     # return an empty list if no pass is used
-    return []
+    return p4_passes
+
+
+def list_dumped_passes(p4_dmp_dir, p4_file):
+    # fall back to the dump folder, the files are written in pass order
+    dumps = p4_dmp_dir.glob(f"{p4_file.stem}-*.p4")
+    return sorted(dumps, key=lambda dump: dump.stat().st_mtime_ns)
 
 
 def gen_p4_passes(p4c_bin, p4_dmp_dir, p4_file):
     util.check_dir(p4_dmp_dir)
-    # ignore the compiler output here, for now.
+    # ignore the compiler exit code here, for now.
     result = generate_p4_dump(p4c_bin, p4_file, p4_dmp_dir)
-    # log.warning(result.stderr.decode('utf-8'))
-    # if result.returncode == 1:
-    # return []
-    p4_passes = list_passes(p4c_bin, p4_file, p4_dmp_dir)
+    p4_passes = list_passes(result.stdout.decode("utf-8", "replace"))
     full_p4_passes = []
     for p4_pass in p4_passes:
         p4_name = f"{p4_file.stem}-{p4_pass}.p4"
         full_p4_pass = p4_dmp_dir.joinpath(p4_name)
-        full_p4_passes.append(full_p4_pass)
+        # passes that did not run to completion did not emit a dump
+        if full_p4_pass.exists():
+            full_p4_passes.append(full_p4_pass)
+    if not full_p4_passes:
+        full_p4_passes = list_dumped_passes(p4_dmp_dir, p4_file)
     return full_p4_passes
 
 
 def prune_passes(p4_passes):
+    """ Remove every pass whose normalized content matches the pass before
+        it, the pair is equivalent by construction. A pass that reverts to
+        an older version is kept, it still has to be compared with the pass
+        it reverts. Returns the chain and the name of the original pass at
+        each position of the chain.
+    """
     pruned_passes = []
-
-    def sha256(fname):
-        hash_sha256 = hashlib.sha256()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
-
-    hash_prev = None
+    pass_names = []
+    last_hash = None
     for p4_pass in p4_passes:
-        hash_sha256 = sha256(p4_pass)
-        if hash_prev == hash_sha256:
+        pass_hash = hashlib.sha256(normalize_pass(p4_pass)).hexdigest()
+        if pass_hash == last_hash:
             log.debug("Deleting file from test set:\n%s", p4_pass)
             os.remove(p4_pass)
-        else:
-            pruned_passes.append(p4_pass)
-        hash_prev = hash_sha256
-    return pruned_passes
+            continue
+        last_hash = pass_hash
+        pruned_passes.append(p4_pass)
+        pass_names.append(str(p4_pass))
+    return pruned_passes, pass_names
 
 
-def validate_translation(p4_file, target_dir, p4c_bin,
-                         allow_undef=False, dump_info=False):
-    info = INFO
+def dump_passes(p4_file, target_dir, p4c_bin):
+    util.check_dir(target_dir)
+    # run the p4 compiler and dump all the passes for this file
+    passes = gen_p4_passes(p4c_bin, target_dir, p4_file)
+    return prune_passes(passes)
+
+
+def check_passes(p4_file, target_dir, p4c_bin, passes, allow_undef=False,
+                 dump_info=False, bisect=False, cache_dir=None,
+                 check_opts=None, pass_names=None):
+    # copy the template, this may run many times in the same process
+    info = dict(INFO)
 
     # customize the main info with the new information
     info["compiler"] = str(p4c_bin)
@@ -164,26 +218,47 @@ def validate_translation(p4_file, target_dir, p4c_bin,
     info["out_dir"] = str(target_dir)
     info["input_file"] = str(p4_file)
     info["allow_undef"] = allow_undef
+    info["bisect"] = bisect
     info["validation_bin"] = f"python3 {__file__}"
+    info["passes"] = len(passes)
+    if pass_names is None:
+        pass_names = [str(p4_pass) for p4_pass in passes]
+    info["pass_names"] = pass_names
 
-    log.info("\n" + "-" * 70)
-    log.info("Analysing %s", p4_file)
-    start_time = datetime.now()
-    util.check_dir(target_dir)
     fail_dir = target_dir.joinpath("failed")
-    # run the p4 compiler and dump all the passes for this file
-    passes = gen_p4_passes(p4c_bin, target_dir, p4_file)
-    passes = prune_passes(passes)
-    p4_py_files = []
     # for each emitted pass, generate a python representation
     if len(passes) < 2:
         log.warning("P4 file did not generate enough passes!")
         return util.EXIT_SKIPPED
     # perform the actual comparison
-    result, check_info = z3check.z3_check(passes, fail_dir, allow_undef)
+    cache = None
+    if cache_dir:
+        # the cache is shared by all programs that use the same folder
+        cache = VerdictCache(Path(cache_dir).joinpath(CACHE_NAME))
+    result, check_info = z3check.z3_check(passes, fail_dir, allow_undef,
+                                          bisect, cache, check_opts,
+                                          pass_names)
     # merge the two info dicts
     info["exit_code"] = result
     info = {**info, **check_info}
+    if dump_info:
+        json_name = target_dir.joinpath(f"{p4_file.stem}_info.json")
+        log.info("Dumping configuration to %s.", json_name)
+        with open(json_name, 'w') as json_file:
+            json.dump(info, json_file, indent=2, sort_keys=True)
+    return result
+
+
+def validate_translation(p4_file, target_dir, p4c_bin,
+                         allow_undef=False, dump_info=False, bisect=False,
+                         cache_dir=None, check_opts=None):
+    log.info("\n" + "-" * 70)
+    log.info("Analysing %s", p4_file)
+    start_time = datetime.now()
+    passes, pass_names = dump_passes(p4_file, target_dir, p4c_bin)
+    result = check_passes(p4_file, target_dir, p4c_bin, passes, allow_undef,
+                          dump_info, bisect, cache_dir, check_opts,
+                          pass_names)
     done_time = datetime.now()
     elapsed = done_time - start_time
     time_str = time.strftime("%H hours %M minutes %S seconds",
@@ -191,14 +266,152 @@ def validate_translation(p4_file, target_dir, p4c_bin,
     ms = elapsed.microseconds / 1000
     log.info("Translation validation took %s %s milliseconds.",
              time_str, ms)
-    if dump_info:
-        json_name = target_dir.joinpath(f"{p4_file.stem}_info.json")
-        log.info("Dumping configuration to %s.", json_name)
-        with open(json_name, 'w') as json_file:
-            json.dump(info, json_file, indent=2, sort_keys=True)
     return result
 
 
+def validate_served(p4_file, target_dir, p4c_bin, allow_undef=False,
+                    dump_info=False, bisect=False, cache_dir=None,
+                    check_opts=None, log_file=None):
+    # a running semantics server already has all the modules loaded
+    # returns None if there is no server, the caller does the work then
+    params = {
+        "p4_file": str(p4_file.resolve()),
+        "target_dir": str(target_dir.resolve()),
+        "p4c_bin": str(p4c_bin),
+        "allow_undef": allow_undef,
+        "dump_info": dump_info,
+        "bisect": bisect,
+        "check_opts": check_opts,
+    }
+    if os.path.exists(p4c_bin):
+        # the server does not share our working directory
+        params["p4c_bin"] = str(Path(p4c_bin).resolve())
+    if cache_dir:
+        params["cache_dir"] = str(Path(cache_dir).resolve())
+    if log_file:
+        # the server appends the log of the request to our log file
+        params["log_file"] = str(Path(log_file).resolve())
+    response = util.call_server("validate_translation", params)
+    if response is None:
+        return None
+    return response["result"]
+
+
+def get_summary_row(p4_file, output_dir, status, result, elapsed):
+    row = {"input_file": str(p4_file), "status": status, "exit_code": result,
+           "passes": None, "elapsed": elapsed,
+           "prog_before": "", "prog_after": "", "pass_before": "",
+           "pass_after": ""}
+    info_file = output_dir.joinpath(f"{p4_file.stem}_info.json")
+    if status != "timeout" and info_file.exists():
+        with open(info_file, "r") as json_file:
+            info = json.load(json_file)
+        row["passes"] = info.get("passes")
+        row["prog_before"] = info.get("prog_before", "")
+        row["prog_after"] = info.get("prog_after", "")
+        row["pass_before"] = info.get("pass_before", "")
+        row["pass_after"] = info.get("pass_after", "")
+    return row
+
+
+def init_corpus_worker(log_file, log_level):
+    # workers start from a clean interpreter, give them the setup of main
+    logging.basicConfig(filename=log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, log_level),
+                        filemode="a")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+
+
+def validate_corpus_file(job):
+    # runs in a scheduler worker, the scheduler kills the worker together
+    # with its compilers and solvers once the file exceeds its deadline
+    (p4_file, output_dir, p4c_bin, allow_undef, bisect, cache_dir,
+     check_opts) = job
+    util.del_dir(output_dir)
+    start_time = time.perf_counter()
+    try:
+        result = validate_translation(p4_file, output_dir, p4c_bin,
+                                      allow_undef, True, bisect, cache_dir,
+                                      check_opts)
+        status = STATUS_NAMES.get(result, "failure")
+    except Exception:
+        log.exception("Validation of %s crashed:\n", p4_file)
+        result = util.EXIT_FAILURE
+        status = "failure"
+    return get_summary_row(p4_file, output_dir, status, result,
+                           time.perf_counter() - start_time)
+
+
+def load_summary(summary_dir):
+    json_name = summary_dir.joinpath(f"{SUMMARY_NAME}.json")
+    if not json_name.exists():
+        return {}
+    with open(json_name, "r") as json_file:
+        rows = json.load(json_file)
+    return {row["input_file"]: row for row in rows}
+
+
+def dump_summary(summary_dir, summary):
+    rows = [summary[p4_file] for p4_file in sorted(summary)]
+    json_name = summary_dir.joinpath(f"{SUMMARY_NAME}.json")
+    # write a temporary file first, an interrupted run must not lose results
+    tmp_name = json_name.with_suffix(".tmp")
+    with open(tmp_name, "w") as json_file:
+        json.dump(rows, json_file, indent=2)
+    os.replace(tmp_name, json_name)
+    csv_name = summary_dir.joinpath(f"{SUMMARY_NAME}.csv")
+    with open(csv_name, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def validate_corpus(p4_files, pass_dir, p4c_bin, allow_undef=False,
+                    bisect=False, cache_dir=None, num_processes=NUM_PROCESSES,
+                    timeout=FILE_TIMEOUT, resume=False, check_opts=None,
+                    input_dir=None, log_file=None, log_level="INFO"):
+    util.check_dir(pass_dir)
+    summary = load_summary(pass_dir) if resume else {}
+    jobs = []
+    for p4_file in p4_files:
+        if str(p4_file) in summary:
+            log.debug("Skipping %s, it was already validated.", p4_file)
+            continue
+        # files in different folders of the corpus may share their name
+        if input_dir:
+            output_dir = pass_dir.joinpath(
+                p4_file.relative_to(input_dir).with_suffix(""))
+        else:
+            output_dir = pass_dir.joinpath(p4_file.stem)
+        jobs.append((p4_file, output_dir, p4c_bin, allow_undef, bisect,
+                     cache_dir, check_opts))
+    log.info("Validating %s files with %s processes, %s already done.",
+             len(jobs), num_processes, len(p4_files) - len(jobs))
+    # z3 does not return to the interpreter while it solves, so an alarm in
+    # the worker cannot stop it, the scheduler kills the worker instead
+    scheduler = TaskScheduler(validate_corpus_file, num_processes, timeout,
+                              initializer=init_corpus_worker,
+                              initargs=(log_file, log_level))
+    for task_result in scheduler.imap_unordered(jobs):
+        row = task_result.value
+        if task_result.status != TASK_DONE:
+            p4_file, output_dir = task_result.task[:2]
+            status = "failure"
+            if task_result.status == TASK_TIMEOUT:
+                log.error("Validation of %s timed out.", p4_file)
+                status = "timeout"
+            row = get_summary_row(p4_file, output_dir, status,
+                                  util.EXIT_FAILURE, task_result.elapsed)
+        log.info("%s: %s", row["input_file"], row["status"])
+        summary[row["input_file"]] = row
+        dump_summary(pass_dir, summary)
+    dump_summary(pass_dir, summary)
+    return summary
+
+
 def main(args):
 
     p4_input = Path(args.p4_input).resolve()
@@ -206,19 +419,28 @@ def main(args):
     p4c_bin = args.p4c_bin
     allow_undef = args.allow_undef
     dunp_info = args.dunp_info
+    bisect = args.bisect
+    cache_dir = args.cache_dir
+    check_opts = z3check.get_check_opts(args)
     if os.path.isfile(p4_input):
         pass_dir = pass_dir.joinpath(p4_input.stem)
         util.del_dir(pass_dir)
-        result = validate_translation(
-            p4_input, pass_dir, p4c_bin, allow_undef, dunp_info)
+        result = None
+        if not args.no_server:
+            result = validate_served(p4_input, pass_dir, p4c_bin, allow_undef,
+                                     dunp_info, bisect, cache_dir, check_opts,
+                                     args.log_file)
+        if result is None:
+            result = validate_translation(
+                p4_input, pass_dir, p4c_bin, allow_undef, dunp_info, bisect,
+                cache_dir, check_opts)
         sys.exit(result)
     elif os.path.isdir(p4_input):
-        util.check_dir(pass_dir)
-        for p4_file in list(p4_input.glob("**/*.p4")):
-            output_dir = pass_dir.joinpath(p4_file.stem)
-            util.del_dir(output_dir)
-            validate_translation(
-                p4_file, output_dir, p4c_bin, allow_undef)
+        p4_files = sorted(p4_input.glob("**/*.p4"))
+        validate_corpus(p4_files, pass_dir, p4c_bin, allow_undef, bisect,
+                        cache_dir, args.num_processes, args.timeout,
+                        args.resume, check_opts, p4_input, args.log_file,
+                        args.log_level)
         result = util.EXIT_SUCCESS
     else:
         log.error("Input file \"%s\" does not exist!", p4_input)
@@ -242,6 +464,30 @@ if __name__ == '__main__':
     parser.add_argument("-u", "--allow_undefined", dest="allow_undef",
                         action="store_true",
                         help="Ignore changes in undefined behavior.")
+    parser.add_argument("-b", "--bisect", dest="bisect",
+                        action="store_true",
+                        help="Only compare the first and last pass and "
+                             "bisect the passes if they are not equivalent.")
+    parser.add_argument("-c", "--cache_dir", dest="cache_dir",
+                        default=None,
+                        help="Store and reuse equivalence verdicts "
+                             "in this folder.")
+    parser.add_argument("-n", "--num_processes", dest="num_processes",
+                        default=NUM_PROCESSES, type=int,
+                        help="How many files to validate in parallel "
+                             "if the input is a directory.")
+    parser.add_argument("-t", "--timeout", dest="timeout",
+                        default=FILE_TIMEOUT, type=int,
+                        help="The maximum time in seconds spent on a "
+                             "single file if the input is a directory.")
+    parser.add_argument("-r", "--resume", dest="resume",
+                        action="store_true",
+                        help="Skip the files listed in the summary of a "
+                             "previous run on the same output folder.")
+    parser.add_argument("--no_server", dest="no_server",
+                        action="store_true",
+                        help="Do not send the validation to a running "
+                             "semantics server, always run it locally.")
     parser.add_argument("-l", "--log_file", dest="log_file",
                         default="analysis.log",
                         help="Specifies name of the log file.")
@@ -254,6 +500,7 @@ if __name__ == '__main__':
                         choices=["CRITICAL", "ERROR", "WARNING",
                                  "INFO", "DEBUG", "NOTSET"],
                         help="The log level to choose.")
+    z3check.add_check_args(parser)
     # Parse options and process argv
     arguments = parser.parse_args()
     # configure logging
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = "verdicts.sqlite"
+# the maximum number of verdicts we keep before evicting old entries
+MAX_ENTRIES = 100000
+# how long to wait for a concurrent writer to release the database
+BUSY_TIMEOUT = 60
+
+
+def get_query_key(*parts):
+    # content-addressed key, all parts are serialized strings or bytes
+    hash_sha256 = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        hash_sha256.update(part)
+        # separate the parts so that concatenations do not collide
+        hash_sha256.update(b"\0")
+    return hash_sha256.hexdigest()
+
+
+def get_file_key(*file_paths):
+    # key for a list of files, hashes the file content, not the name
+    hash_sha256 = hashlib.sha256()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                hash_sha256.update(chunk)
+        hash_sha256.update(b"\0")
+    return hash_sha256.hexdigest()
+
+
+def get_bin_key(bin_path):
+    # identify a binary by its location, size, and modification time
+    try:
+        stat = os.stat(bin_path)
+    except OSError:
+        return str(bin_path)
+    return f"{bin_path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class VerdictCache():
+    ''' A persistent cache of equivalence verdicts backed by SQLite.
+    The database is shared between processes, every process opens its own
+    connection. The cache evicts the least recently used entries once it
+    holds more than max_entries verdicts. Triggers keep the number of
+    verdicts in a metadata row, so a put does not have to count them. '''
+
+    def __init__(self, cache_file, max_entries=MAX_ENTRIES):
+        self.cache_file = Path(cache_file)
+        self.max_entries = max_entries
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # sqlite connections must not be shared across forked processes
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.cache_file), timeout=BUSY_TIMEOUT)
+        # write-ahead logging allows readers during concurrent writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                         "key TEXT PRIMARY KEY, "
+                         "verdict TEXT, "
+                         "exit_code INTEGER, "
+                         "model TEXT, "
+                         "last_used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used "
+                         "ON verdicts (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS verdicts_meta ("
+                         "name TEXT PRIMARY KEY, "
+                         "value INTEGER)")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS verdicts_insert "
+                         "AFTER INSERT ON verdicts BEGIN "
+                         "UPDATE verdicts_meta SET value = value + 1 "
+                         "WHERE name = 'num_entries'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS verdicts_delete "
+                         "AFTER DELETE ON verdicts BEGIN "
+                         "UPDATE verdicts_meta SET value = value - 1 "
+                         "WHERE name = 'num_entries'; END")
+            row = conn.execute("SELECT value FROM verdicts_meta "
+                               "WHERE name = 'num_entries'").fetchone()
+            if row is None:
+                # a new database or one from before the metadata table
+                conn.execute("INSERT INTO verdicts_meta (name, value) "
+                             "SELECT 'num_entries', COUNT(*) FROM verdicts")
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        ''' Returns a (verdict, exit_code, model) tuple or None. '''
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT verdict, exit_code, model FROM verdicts "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute("UPDATE verdicts SET last_used = ? "
+                             "WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            # the cache is an optimization, never fail because of it
+            log.warning("Could not read from verdict cache: %s", e)
+            return None
+        log.debug("Found cached verdict for %s", key)
+        return row
+
+    def put(self, key, verdict, exit_code, model=""):
+        try:
+            conn = self._connect()
+            with conn:
+                # an upsert, unlike a replace, only fires the insert trigger
+                # for new keys
+                conn.execute(
+                    "INSERT INTO verdicts "
+                    "(key, verdict, exit_code, model, last_used) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET "
+                    "verdict = excluded.verdict, "
+                    "exit_code = excluded.exit_code, "
+                    "model = excluded.model, "
+                    "last_used = excluded.last_used",
+                    (key, verdict, exit_code, model, time.time()))
+                self._evict(conn)
+        except sqlite3.Error as e:
+            log.warning("Could not write to verdict cache: %s", e)
+
+    def _evict(self, conn):
+        num_entries = conn.execute(
+            "SELECT value FROM verdicts_meta "
+            "WHERE name = 'num_entries'").fetchone()[0]
+        overflow = num_entries - self.max_entries
+        if overflow > 0:
+            log.debug("Evicting %s entries from verdict cache.", overflow)
+            conn.execute(
+                "DELETE FROM verdicts WHERE key IN ("
+                "SELECT key FROM verdicts ORDER BY last_used ASC LIMIT ?)",
+                (overflow,))
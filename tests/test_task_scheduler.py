@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath("src")))
+
+from task_scheduler import TaskScheduler  # noqa: E402
+from task_scheduler import TASK_DONE, TASK_ERROR  # noqa: E402
+from task_scheduler import TASK_TIMEOUT, TASK_CRASHED  # noqa: E402
+
+
+def run_task(task):
+    if task == "hang":
+        while True:
+            pass
+    if task == "crash":
+        os._exit(1)
+    if task == "error":
+        raise ValueError(task)
+    return task * 2
+
+
+def test_imap_unordered_results():
+    scheduler = TaskScheduler(run_task, 2)
+    results = list(scheduler.imap_unordered(range(10)))
+    assert sorted(result.task for result in results) == list(range(10))
+    for result in results:
+        assert result.status == TASK_DONE
+        assert result.value == result.task * 2
+
+
+def test_imap_unordered_failures():
+    scheduler = TaskScheduler(run_task, 2, task_timeout=1)
+    start_time = time.monotonic()
+    results = {result.task: result for result in
+               scheduler.imap_unordered(["hang", "crash", "error", 1])}
+    # the hanging task must not hold up the stream for long
+    assert time.monotonic() - start_time < 30
+    # statuses are strings, a shadowed status constant would not match
+    assert results["hang"].status == TASK_TIMEOUT == "timeout"
+    assert results["crash"].status == TASK_CRASHED
+    assert results["error"].status == TASK_ERROR
+    assert "ValueError" in results["error"].value
+    assert results[1].status == TASK_DONE
+    assert results[1].value == 2
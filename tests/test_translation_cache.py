@@ -0,0 +1,42 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath("src")))
+
+from translation_cache import TranslationCache  # noqa: E402
+
+
+def list_entries(cache_dir):
+    return sorted(entry.name for entry in cache_dir.glob("*.py"))
+
+
+def test_evict_across_cache_objects(tmp_path):
+    # every short-lived process creates its own cache object
+    for idx in range(5):
+        cache = TranslationCache(tmp_path, max_entries=2)
+        cache.put_data(f"key{idx}", b"ir")
+    assert len(list_entries(tmp_path)) <= 2
+    # the most recent entry must survive
+    assert "key4.py" in list_entries(tmp_path)
+
+
+def test_evict_single_cache_object(tmp_path):
+    cache = TranslationCache(tmp_path, max_entries=10)
+    for idx in range(100):
+        cache.put_data(f"key{idx}", b"ir")
+    assert len(list_entries(tmp_path)) <= 10
+    assert cache.get_data("key99") == b"ir"
+
+
+def test_evict_keeps_recently_used(tmp_path):
+    cache = TranslationCache(tmp_path, max_entries=3)
+    for idx, key in enumerate(("old", "mid", "new")):
+        cache.put_data(key, b"ir")
+        # modification times may tie within the same tick
+        os.utime(tmp_path.joinpath(f"{key}.py"), (idx, idx))
+    # reading an entry marks it as used
+    other = TranslationCache(tmp_path, max_entries=3)
+    assert other.get_data("old") == b"ir"
+    other.put_data("newest", b"ir")
+    assert list_entries(tmp_path) == ["newest.py", "old.py"]